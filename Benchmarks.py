@@ -0,0 +1,117 @@
+"""
+benchmarks of the client-side processing of the results and of the requests. no requests are made to the Event Registry -
+the requests are answered by a local MockServer
+"""
+import sys, json, time, random
+from EventRegistry import *
+from MockServer import MockServer
+
+# return the total memory used by the object and all objects it references. objects that are shared
+# (such as interned strings) are counted only once
+def deepSizeOf(obj, seen = None):
+    if seen == None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deepSizeOf(key, seen) + deepSizeOf(val, seen) for key, val in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deepSizeOf(val, seen) for val in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deepSizeOf(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    return size
+
+# create a response with count articles that resembles the response of RequestArticlesInfo(includeArticleConcepts = True, includeArticleCategories = True)
+def createArticlesResponse(count, bodyLen = 300, seed = 0):
+    rnd = random.Random(seed)
+    sources = [{ "uri": "source%d.com" % i, "title": "Source %d" % i } for i in range(200)]
+    concepts = [{ "uri": "http://en.wikipedia.org/wiki/Concept_%d" % i, "type": rnd.choice(["person", "org", "loc", "wiki"]), "label": { "eng": "Concept %d" % i } } for i in range(2000)]
+    articles = []
+    for i in range(count):
+        articles.append({
+            "uri": str(200000000 + i),
+            "lang": rnd.choice(["eng", "deu", "spa"]),
+            "date": "2014-04-%02d" % rnd.randint(1, 28),
+            "time": "%02d:%02d:%02d" % (rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59)),
+            "url": "http://www.example.com/news/%d" % i,
+            "title": "Title of the article %d" % i,
+            "body": "x" * bodyLen,
+            "source": rnd.choice(sources),
+            "eventUri": str(rnd.randint(1000000, 1001000)),
+            "sim": rnd.random(),
+            "isDuplicate": False,
+            "concepts": [dict(concept, score = rnd.randint(1, 5)) for concept in rnd.sample(concepts, 10)],
+            "categories": [{ "uri": "dmoz/Category/%d" % rnd.randint(0, 100), "label": "dmoz/Category", "wgt": 50 }]
+            })
+    # serialize and parse the response so that the strings are not shared, as in a parsed response
+    return json.loads(json.dumps({ "articles": { "resultCount": count, "results": articles }}))
+
+# compare the memory used by the parsed articles and by the ArticleRecord objects
+def benchmarkArticleRecords(count = 10000):
+    res = createArticlesResponse(count)
+    dictSize = deepSizeOf(res["articles"]["results"])
+    startTime = time.time()
+    records = ArticleRecord.fromResults(res)
+    elapsed = time.time() - startTime
+    recordSize = deepSizeOf(records)
+    print "%d articles: dicts %.1f MB, ArticleRecord %.1f MB (%.0f%% less), created in %.3f s (%.1f us per article)" % (
+        count, dictSize / 1e6, recordSize / 1e6, 100.0 * (dictSize - recordSize) / dictSize, elapsed, 1e6 * elapsed / count)
+    records = ArticleRecord.fromResults(res, includeBody = False)
+    recordSize = deepSizeOf(records)
+    print "%d articles without body: ArticleRecord %.1f MB (%.0f%% less)" % (count, recordSize / 1e6, 100.0 * (dictSize - recordSize) / dictSize)
+
+# measure the time that the client spends on encoding a query and on parsing and converting a response
+def benchmarkClientOverhead(iterations = 200, pageSize = 100):
+    q = QueryArticles(conceptUri = ["http://en.wikipedia.org/wiki/Concept_%d" % i for i in range(50)], lang = ["eng", "deu", "spa"])
+    q.addRequestedResult(RequestArticlesInfo(count = pageSize, includeArticleConcepts = True))
+    respInfo = json.dumps(createArticlesResponse(pageSize))
+    res = json.loads(respInfo)
+    for name, func in [("Query._encode", lambda: q._encode("user", "pass")),
+                       ("json.loads", lambda: json.loads(respInfo)),
+                       ("createStructFromDict", lambda: createStructFromDict(res)),
+                       ("ArticleRecord.fromResults", lambda: ArticleRecord.fromResults(res))]:
+        startTime = time.time()
+        for i in xrange(iterations):
+            func()
+        elapsed = time.time() - startTime
+        print "%-26s %8.1f us per call (%d articles, %.0f KB response)" % (name, 1e6 * elapsed / iterations, pageSize, len(respInfo) / 1e3)
+
+# return the p-th percentile (0-100) of the values
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+# execute requestCount queries against a local MockServer that delays each response by latency seconds. the queries are executed
+# one by one with a new connection for every request (serial), one by one over the keep-alive connections (pooled) and in parallel
+# by the given number of workers (concurrent). the throughput and the latency percentiles are printed for each mode
+def benchmarkRequests(requestCount = 300, latency = 0.005, pageSize = 50, bodyLen = 1000, workers = 8):
+    with MockServer(latency = latency, bodyLen = bodyLen) as server:
+        for mode in ["serial", "pooled", "concurrent"]:
+            er = EventRegistry(host = server.getUrl(), minDelayBetweenRequests = 0, cacheUris = False,
+                               connectionPoolSize = 0 if mode == "serial" else workers, maxConnectionsPerHost = workers)
+            latencies = []
+            er.setRequestAttemptCallback(lambda info: latencies.append(info["latency"]))
+            queries = []
+            for page in range(requestCount):
+                q = QueryArticles(conceptUri = "http://en.wikipedia.org/wiki/Concept_1")
+                q.addRequestedResult(RequestArticlesInfo(page = page, count = pageSize))
+                queries.append(q)
+            startTime = time.time()
+            if mode == "concurrent":
+                er.execQueries(queries, workers)
+            else:
+                for q in queries:
+                    er.execQuery(q)
+            elapsed = time.time() - startTime
+            print "%-10s %d requests in %.2f s: %6.0f requests/s, latency p50 %.1f ms, p90 %.1f ms, p99 %.1f ms" % (
+                mode, requestCount, elapsed, requestCount / elapsed, 1e3 * percentile(latencies, 50), 1e3 * percentile(latencies, 90), 1e3 * percentile(latencies, 99))
+
+
+if __name__ == "__main__":
+    benchmarkArticleRecords()
+    benchmarkClientOverhead()
+    benchmarkRequests()
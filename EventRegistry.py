@@ -1,8 +1,10 @@
 """
 classes responsible for obtaining results from the Event Registry
 """
-import os, sys, urllib2, urllib, json, datetime, time, re;
+import os, sys, urllib2, urllib, urlparse, httplib, socket, threading, Queue, StringIO, json, datetime, time, random, hashlib, zlib, sqlite3, contextlib, copy, re, gzip, math, atexit;
 from cookielib import CookieJar
+from collections import OrderedDict, deque
+from array import array
 
 mainLangs = ["eng", "deu", "zho", "slv", "spa"]
 allLangs = [ "eng", "deu", "spa", "cat", "por", "ita", "fra", "rus", "ara", "tur", "zho", "slv", "hrv", "srp" ]
@@ -14,6 +16,33 @@ def removeInvalidChars(text):
     return invalidCharRe.sub("", text);
 
 
+# parameters that identify the user and not the request - they are ignored when computing the fingerprint of a request
+credentialParams = ["erUsername", "erPassword"]
+
+# return a fingerprint of the request made to path with the parameters params. the fingerprint does not depend on the
+# order of the parameters (or the order of values in list parameters) or on the user credentials
+def getRequestFingerprint(path, params):
+    canonical = {}
+    for key, val in params.iteritems():
+        if key in credentialParams:
+            continue
+        if isinstance(val, (list, tuple, set, frozenset)):
+            val = sorted(val)
+        canonical[key] = val
+    return hashlib.sha1(json.dumps([path, canonical], sort_keys = True, default = str)).hexdigest()
+
+# return True if the response (a json string) is an error document, such as { "error": "..." }. the service returns such
+# documents (e.g. when the daily quota is exceeded) with the status 200, so they look like the successful responses
+def isErrorResponse(response):
+    if '"error"' not in response:
+        return False
+    try:
+        res = json.loads(response)
+    except ValueError:
+        return True
+    return isinstance(res, dict) and "error" in res
+
+
 class Struct(object):
     """
     general class for converting dict to a native python object
@@ -29,15 +58,628 @@ class Struct(object):
         else:
             return Struct(value) if isinstance(value, dict) else value
 
-def createStructFromDict(data):
+def createStructFromDict(data, lazy = False):
     """
     method to convert a list or dict to a native python object
+    if lazy is True then a read-only view of the data is returned (see LazyStruct)
     """
+    if lazy:
+        return _wrapLazy(data)
     if isinstance(data, list):
         return type(data)([createStructFromDict(v) for v in data])
     else:
         return Struct(data)
 
+
+def _wrapLazy(value):
+    if isinstance(value, dict):
+        return LazyStruct(value)
+    if isinstance(value, (list, tuple)):
+        return LazyList(value)
+    return value
+
+class LazyStruct(object):
+    """
+    read-only view of a dict that allows writing a.b.c instead of a["b"]["c"]
+    unlike Struct, the data is not copied - nested dicts and lists are wrapped only
+    when they are accessed and the wrapped values are cached
+    """
+    __slots__ = ("_data", "_wrapped")
+
+    def __init__(self, data):
+        self._data = data
+        self._wrapped = None
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        try:
+            value = self._data[name]
+        except KeyError:
+            raise AttributeError(name)
+        if not isinstance(value, (dict, list, tuple)):
+            return value
+        if self._wrapped == None:
+            self._wrapped = {}
+        wrapped = self._wrapped.get(name)
+        if wrapped == None:
+            wrapped = self._wrapped[name] = _wrapLazy(value)
+        return wrapped
+
+    def __getitem__(self, name):
+        try:
+            return self.__getattr__(name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __contains__(self, name):
+        return name in self._data
+
+    def __dir__(self):
+        return self._data.keys()
+
+    def __repr__(self):
+        return "LazyStruct(%r)" % (self._data,)
+
+class LazyList(object):
+    """
+    read-only view of a list in which the dicts and lists are wrapped only when they are accessed
+    """
+    __slots__ = ("_data", "_wrapped")
+
+    def __init__(self, data):
+        self._data = data
+        self._wrapped = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(len(self._data)))]
+        value = self._data[index]
+        if not isinstance(value, (dict, list, tuple)):
+            return value
+        if self._wrapped == None:
+            self._wrapped = [None] * len(self._data)
+        wrapped = self._wrapped[index]
+        if wrapped == None:
+            wrapped = self._wrapped[index] = _wrapLazy(value)
+        return wrapped
+
+    def __iter__(self):
+        for i in xrange(len(self._data)):
+            yield self[i]
+
+    def __repr__(self):
+        return "LazyList(%r)" % (self._data,)
+
+# #####################################
+# compact records for keeping large numbers of results in memory
+# #####################################
+
+# the pool of the strings shared by the records. the records can also be given their own pool (a dict) as the strings argument,
+# which is then released together with the records
+_internedStrings = {}
+
+# return a shared instance of the string from the pool strings (by default the shared pool), so that values that repeat in
+# many results (concept uris and types, languages, source uris, ...) are stored only once. only the values with few distinct
+# values should be interned, since the pool keeps all of them. (the built-in intern() doesn't accept unicode strings)
+def internString(text, strings = None):
+    if text == None:
+        return None
+    if strings == None:
+        strings = _internedStrings
+    return strings.setdefault(text, text)
+
+# remove the strings from the shared pool. the records that were already created keep their strings
+def clearInternedStrings():
+    _internedStrings.clear()
+
+# convert a date such as "2014-04-16" to the integer 20140416 (0 for a missing date)
+def dateToInt(date):
+    if not date:
+        return 0
+    return int(date[:10].replace("-", ""))
+
+# convert a time such as "12:34:56" to the number of seconds since midnight (0 for a missing time)
+def timeToInt(timeStr):
+    if not timeStr:
+        return 0
+    h, m, s = timeStr.split(":")
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+# return the label in the preferred language from a dict of labels in different languages (e.g. { "eng": "Berlin" })
+def _getLabel(labels, lang):
+    if not isinstance(labels, dict):
+        return labels
+    if lang in labels:
+        return labels[lang]
+    return next(labels.itervalues(), None)
+
+# return the list of results from a response (e.g. { "articles": { "results": [...] } }) or from a list of results
+def _getResultList(res, resultKey):
+    if isinstance(res, dict):
+        res = res.get(resultKey, res)
+        res = res.get("results", []) if isinstance(res, dict) else res
+    return res
+
+
+class ConceptRef(object):
+    """
+    compact reference to a concept mentioned in an article or event
+    """
+    __slots__ = ("uri", "type", "score", "label")
+
+    def __init__(self, uri, type, score, label):
+        self.uri = uri
+        self.type = type
+        self.score = score
+        self.label = label
+
+    # create a tuple of references to the concepts in the list of concept dicts (as returned in the articles and events)
+    @staticmethod
+    def fromDicts(concepts, lang = "eng", strings = None):
+        # this is called for every article or event, so internString and _getLabel are inlined
+        intern = (strings if strings != None else _internedStrings).setdefault
+        refs = []
+        for concept in concepts:
+            uri = concept.get("uri")
+            conceptType = concept.get("type")
+            label = concept.get("label")
+            if isinstance(label, dict):
+                label = label[lang] if lang in label else next(label.itervalues(), None)
+            refs.append(ConceptRef(uri and intern(uri, uri), conceptType and intern(conceptType, conceptType), concept.get("score", 0), label))
+        return tuple(refs)
+
+    def __repr__(self):
+        return "ConceptRef(%r)" % self.uri
+
+
+class ArticleRecord(object):
+    """
+    compact representation of an article returned by RequestArticlesInfo (or other article lists)
+    the language, source uri, concept uris and types and category uris are interned (in strings, by default the shared pool),
+    the date is stored as an int (20140416) and the time as seconds since midnight
+    """
+    __slots__ = ("uri", "lang", "date", "time", "url", "title", "body", "sourceUri", "sourceTitle", "eventUri", "sim", "isDuplicate", "concepts", "categories")
+
+    def __init__(self, article, includeBody = True, lang = "eng", strings = None):
+        self.uri = article.get("uri")
+        self.lang = internString(article.get("lang"), strings)
+        self.date = dateToInt(article.get("date"))
+        self.time = timeToInt(article.get("time"))
+        self.url = article.get("url")
+        self.title = article.get("title")
+        self.body = article.get("body") if includeBody else None
+        source = article.get("source") or {}
+        self.sourceUri = internString(source.get("uri"), strings)
+        self.sourceTitle = source.get("title")
+        self.eventUri = article.get("eventUri")
+        self.sim = article.get("sim", 0)
+        self.isDuplicate = article.get("isDuplicate", False)
+        self.concepts = ConceptRef.fromDicts(article.get("concepts", ()), lang, strings)
+        self.categories = tuple([internString(category.get("uri"), strings) for category in article.get("categories", ())])
+
+    # create the records for all articles in the response (e.g. { "articles": { "results": [...] } }) or a list of articles
+    @staticmethod
+    def fromResults(res, includeBody = True, lang = "eng", strings = None):
+        return [ArticleRecord(article, includeBody, lang, strings) for article in _getResultList(res, "articles")]
+
+    def __repr__(self):
+        return "ArticleRecord(%r)" % self.uri
+
+
+class EventRecord(object):
+    """
+    compact representation of an event returned by RequestEventsInfo
+    the concept uris and types and category uris are interned (in strings, by default the shared pool) and the dates are stored as ints (20140416)
+    """
+    __slots__ = ("uri", "date", "dateEnd", "articleCount", "wgt", "title", "concepts", "categories")
+
+    def __init__(self, event, lang = "eng", strings = None):
+        self.uri = event.get("uri")
+        self.date = dateToInt(event.get("eventDate"))
+        self.dateEnd = dateToInt(event.get("eventDateEnd"))
+        self.articleCount = (event.get("articleCounts") or {}).get("total", 0)
+        self.wgt = event.get("wgt", 0)
+        info = _getLabel(event.get("multiLingInfo") or {}, lang) or {}
+        self.title = info.get("title")
+        self.concepts = ConceptRef.fromDicts(event.get("concepts", ()), lang, strings)
+        self.categories = tuple([internString(category.get("uri"), strings) for category in event.get("categories", ())])
+
+    # create the records for all events in the response (e.g. { "events": { "results": [...] } }) or a list of events
+    @staticmethod
+    def fromResults(res, lang = "eng", strings = None):
+        return [EventRecord(event, lang, strings) for event in _getResultList(res, "events")]
+
+    def __repr__(self):
+        return "EventRecord(%r)" % self.uri
+
+# #####################################
+# conversion of the aggregated results to numpy arrays
+# #####################################
+
+# numpy is only needed for the conversions below, so it is imported when first used
+def _importNumpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("numpy is required for converting the results to arrays (pip install numpy)")
+    return numpy
+
+# return the result under resultKey in the response res (or res itself if it is already the result). the result has to be a dict
+# that contains at least one of the keys, otherwise ValueError is raised (with the error message if res is an error response)
+def _getResult(res, resultKey, keys):
+    if isinstance(res, dict) and resultKey in res:
+        res = res[resultKey]
+    if not isinstance(res, dict) or not any(key in res for key in keys):
+        error = res.get("error") if isinstance(res, dict) else None
+        raise ValueError(error or "The response doesn't contain the %s" % resultKey)
+    return res
+
+# return the list of items with counts per date from a time aggregate or a trend. the response of a QueryEvent is keyed by the
+# event uri - if it contains the result of a single event, that result is used (otherwise pass res[eventUri])
+def _getDateItems(res, resultKey):
+    if isinstance(res, list):
+        return res
+    if isinstance(res, dict) and resultKey not in res:
+        eventResults = [val for val in res.itervalues() if isinstance(val, dict) and resultKey in val]
+        if len(eventResults) > 1:
+            raise ValueError("The response contains the %s of several events, pass the result of one of them (res[eventUri])" % resultKey)
+        if eventResults:
+            res = eventResults[0]
+    if isinstance(res, dict) and isinstance(res.get(resultKey), list):
+        return res[resultKey]
+    res = _getResult(res, resultKey, ("results", "trends"))
+    return res.get("results", res.get("trends"))
+
+# convert the dates (e.g. "2014-04-16" or "2014-04-16T12:00:00") to a numpy array of datetime64 values
+def _datesToArray(np, dates, count):
+    dates = np.fromiter(dates, dtype = "S19", count = count)
+    return dates.astype("datetime64[D]" if count == 0 or len(dates[0]) <= 10 else "datetime64[s]")
+
+# convert the result of RequestEventsTimeAggr or RequestArticlesTimeAggr (a list of { "date": ..., "count": ... }) into a tuple
+# of numpy arrays (dates, counts), where dates are datetime64 values. res can be the whole response or just the list
+def timeAggrToArrays(res, resultKey = "timeAggr"):
+    np = _importNumpy()
+    items = _getDateItems(res, resultKey)
+    dates = _datesToArray(np, (item["date"] for item in items), len(items))
+    counts = np.fromiter((item["count"] for item in items), dtype = np.float64, count = len(items))
+    return dates, counts
+
+# convert the result of RequestEventArticleTrend into a tuple of numpy arrays (dates, counts). see timeAggrToArrays. the response
+# of a QueryEvent is keyed by the event uri - with several event uris pass the result of one event (res[eventUri])
+def articleTrendToArrays(res, resultKey = "articleTrend"):
+    return timeAggrToArrays(res, resultKey)
+
+# convert the result of RequestEventsConceptTrends or RequestArticlesConceptTrends into a tuple (conceptUris, dates, matrix), where
+# matrix is a 2d numpy array in which matrix[i, j] is the frequency of the concept conceptUris[i] on the date dates[j].
+# the result is expected to contain the "trends" (a list of { "date": ..., "conceptFreq": [{ "id": ..., "count": ... }, ...] })
+# and the "conceptInfo" (a list of { "id": ..., "uri": ... }) that maps the ids to concept uris
+def conceptTrendsToMatrix(res, resultKey = "conceptTrends"):
+    np = _importNumpy()
+    res = _getResult(res, resultKey, ("trends",))
+    trends = res["trends"]
+    conceptInfo = res.get("conceptInfo", [])
+    # the rows of the matrix are the concepts in the order of conceptInfo, followed by the concepts that are not described in it
+    conceptUris = [concept.get("uri", concept.get("id")) for concept in conceptInfo]
+    rowByKey = dict((concept.get("id", concept.get("uri")), i) for i, concept in enumerate(conceptInfo))
+    def getRow(freq):
+        key = freq.get("id", freq.get("uri"))
+        row = rowByKey.get(key)
+        if row == None:
+            row = rowByKey[key] = len(conceptUris)
+            conceptUris.append(key)
+        return row
+    dates = _datesToArray(np, (trend["date"] for trend in trends), len(trends))
+    cellCount = sum(len(trend.get("conceptFreq", ())) for trend in trends)
+    rows = np.fromiter((getRow(freq) for trend in trends for freq in trend.get("conceptFreq", ())), dtype = np.intp, count = cellCount)
+    cols = np.fromiter((j for j, trend in enumerate(trends) for freq in trend.get("conceptFreq", ())), dtype = np.intp, count = cellCount)
+    counts = np.fromiter((freq["count"] for trend in trends for freq in trend.get("conceptFreq", ())), dtype = np.float64, count = cellCount)
+    matrix = np.zeros((len(conceptUris), len(trends)))
+    matrix[rows, cols] = counts
+    return conceptUris, dates, matrix
+
+# #####################################
+# sparse representation of concept graphs
+# #####################################
+
+class ConceptGraph(object):
+    """
+    compact weighted graph of concepts built from the results of RequestEventsConceptGraph, RequestArticlesConceptGraph,
+    RequestEventsConceptMatrix and RequestArticlesConceptMatrix. the results of many queries can be merged into the same
+    graph - the weights of the links that appear in several results are summed.
+    the concepts are numbered in the order in which they are added (uris[i] is the uri of the concept i, uriIndex maps
+    the uris back to the numbers). the adjacency is returned in the CSR format: the neighbors of the concept i are
+    indices[indptr[i]:indptr[i + 1]] and the weights of the links weights[indptr[i]:indptr[i + 1]]
+    """
+    def __init__(self, directed = False):
+        self.uris = []
+        self.uriIndex = {}
+        self._directed = directed
+        # links that were added so far, stored in compact arrays
+        self._sources = array("l")
+        self._targets = array("l")
+        self._weights = array("d")
+        self._csr = None
+
+    # return the number of the concept with the given uri, adding it to the graph if necessary
+    def getIndex(self, uri):
+        index = self.uriIndex.get(uri)
+        if index == None:
+            index = self.uriIndex[uri] = len(self.uris)
+            self.uris.append(uri)
+        return index
+
+    def addLink(self, sourceUri, targetUri, weight = 1.0):
+        self._addLink(self.getIndex(sourceUri), self.getIndex(targetUri), weight)
+
+    def _addLink(self, source, target, weight):
+        self._sources.append(source)
+        self._targets.append(target)
+        self._weights.append(weight)
+        if not self._directed and source != target:
+            self._sources.append(target)
+            self._targets.append(source)
+            self._weights.append(weight)
+        self._csr = None
+
+    # add the concepts and links from the result of RequestEventsConceptGraph or RequestArticlesConceptGraph. the result is
+    # expected to contain a list of concepts ("nodes" or "concepts", each with an "id" and "uri") and a list of
+    # "links" ({ "source": id, "target": id, "value" or "weight": ... }). res can be the whole response or just the graph
+    def addGraph(self, res, resultKey = "conceptGraph"):
+        res = _getResult(res, resultKey, ("nodes", "concepts", "links"))
+        indexById = {}
+        for concept in res.get("nodes", res.get("concepts", [])):
+            indexById[concept.get("id", concept.get("uri"))] = self.getIndex(concept.get("uri", concept.get("id")))
+        for link in res.get("links", []):
+            source = indexById.get(link["source"])
+            if source == None:
+                source = indexById[link["source"]] = self.getIndex(link["source"])
+            target = indexById.get(link["target"])
+            if target == None:
+                target = indexById[link["target"]] = self.getIndex(link["target"])
+            self._addLink(source, target, link.get("value", link.get("weight", 1.0)))
+
+    # add the concepts and the non-zero values from the result of RequestEventsConceptMatrix or RequestArticlesConceptMatrix. the result
+    # is expected to contain the list of "concepts" (each with a "uri") and the "matrix" - either a list of rows with a value for each
+    # pair of concepts, or a list of cells ({ "i": ..., "j": ..., "value": ... }). res can be the whole response or just the matrix
+    def addMatrix(self, res, resultKey = "conceptMatrix"):
+        res = _getResult(res, resultKey, ("concepts", "matrix"))
+        indexes = [self.getIndex(concept.get("uri", concept.get("id"))) for concept in res.get("concepts", [])]
+        matrix = res.get("matrix", [])
+        for i, row in enumerate(matrix):
+            if isinstance(row, dict):
+                if row.get("value", 0) != 0:
+                    self._addLink(indexes[row["i"]], indexes[row["j"]], row["value"])
+                continue
+            # in a symmetric matrix of an undirected graph only the upper triangle is needed
+            for j in xrange(0 if self._directed else i, len(row)):
+                if row[j] != 0:
+                    self._addLink(indexes[i], indexes[j], row[j])
+
+    # return the adjacency of the graph in the CSR format as a tuple of arrays (indptr, indices, weights)
+    def getCsr(self):
+        if self._csr == None:
+            self._csr = self._buildCsr()
+        return self._csr
+
+    def _buildCsr(self):
+        n = len(self.uris)
+        # count the links of each concept and bucket the links by the source concept
+        indptr = array("l", [0]) * (n + 1)
+        for source in self._sources:
+            indptr[source + 1] += 1
+        for i in xrange(n):
+            indptr[i + 1] += indptr[i]
+        nextPos = array("l", indptr[:n])
+        indices = array("l", [0]) * len(self._sources)
+        weights = array("d", [0.0]) * len(self._sources)
+        for source, target, weight in zip(self._sources, self._targets, self._weights):
+            pos = nextPos[source]
+            indices[pos] = target
+            weights[pos] = weight
+            nextPos[source] = pos + 1
+        # sort the neighbors of each concept and sum the weights of the repeated links
+        outIndptr = array("l", [0]) * (n + 1)
+        outIndices = array("l")
+        outWeights = array("d")
+        for i in xrange(n):
+            lastTarget = -1
+            for target, weight in sorted(zip(indices[indptr[i]:indptr[i + 1]], weights[indptr[i]:indptr[i + 1]])):
+                if target == lastTarget:
+                    outWeights[-1] += weight
+                else:
+                    outIndices.append(target)
+                    outWeights.append(weight)
+                    lastTarget = target
+            outIndptr[i + 1] = len(outIndices)
+        return outIndptr, outIndices, outWeights
+
+    # return the list of (uri, weight) of the concepts that are linked to the concept with the given uri
+    def getNeighbors(self, uri):
+        index = self.uriIndex.get(uri)
+        if index == None:
+            return []
+        indptr, indices, weights = self.getCsr()
+        return [(self.uris[indices[pos]], weights[pos]) for pos in xrange(indptr[index], indptr[index + 1])]
+
+    # return the adjacency as a scipy.sparse.csr_matrix (scipy needs to be installed)
+    def toScipy(self):
+        try:
+            import scipy.sparse
+        except ImportError:
+            raise ImportError("scipy is required for converting the graph to a sparse matrix (pip install scipy)")
+        indptr, indices, weights = self.getCsr()
+        return scipy.sparse.csr_matrix((weights, indices, indptr), shape = (len(self.uris), len(self.uris)))
+
+# #####################################
+# writers for storing the results to files
+# #####################################
+
+# return the value at the given path in the item (e.g. "source.uri" or ["source", "uri"]) or None if it doesn't exist
+def getItemValue(item, path):
+    for key in (path.split(".") if isinstance(path, basestring) else path):
+        if not isinstance(item, dict):
+            return None
+        item = item.get(key)
+    return item
+
+# convert the columns given as paths ("source.uri") or tuples (name, path[, type]) into a list of tuples (name, keys, type)
+def _parseColumns(columns):
+    parsed = []
+    for column in columns:
+        if isinstance(column, basestring):
+            column = (column, column)
+        parsed.append((column[0], column[1].split("."), column[2] if len(column) > 2 else None))
+    return parsed
+
+# return the items from a response (the articles or events in { "articles": { "results": [...] } }) or from any iterable of items,
+# such as EventRegistry.iterArticles or exportArticles
+def _iterResultItems(res):
+    if isinstance(res, dict):
+        for resultKey in ("articles", "events"):
+            if resultKey in res:
+                return _getResultList(res, resultKey)
+        return res.get("results", [])
+    return res
+
+
+class JsonLinesWriter(object):
+    """
+    writes the items to a file with one json object per line. if the file name ends with .gz, the file is compressed with gzip.
+    if columns are given, only these values are written, as a flat object with the column names as keys. the columns are paths
+    in the item ("uri", "source.uri") or tuples (name, path). the lines are buffered and written bufferSize items at a time
+    """
+    def __init__(self, fileName, columns = None, append = False, bufferSize = 1000, compressLevel = 6):
+        mode = "ab" if append else "wb"
+        self._file = gzip.open(fileName, mode, compressLevel) if fileName.endswith(".gz") else open(fileName, mode)
+        self._encode = json.JSONEncoder(separators = (",", ":")).encode
+        self._columns = None
+        if columns != None:
+            self._columns = [(self._encode(name) + ":", keys) for name, keys, type in _parseColumns(columns)]
+        self._bufferSize = bufferSize
+        self._buffer = []
+        self.itemCount = 0
+
+    def write(self, item):
+        if self._columns == None:
+            line = self._encode(item)
+        else:
+            line = "{" + ",".join([prefix + self._encode(getItemValue(item, keys)) for prefix, keys in self._columns]) + "}"
+        self._buffer.append(line)
+        if len(self._buffer) >= self._bufferSize:
+            self.flush()
+
+    # write all the items of the response or iterable (see _iterResultItems). the items are not kept in memory
+    def writeAll(self, res):
+        for item in _iterResultItems(res):
+            self.write(item)
+
+    def flush(self):
+        if self._buffer:
+            self._file.write("\n".join(self._buffer) + "\n")
+            self.itemCount += len(self._buffer)
+            self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+
+class NpzWriter(object):
+    """
+    collects the numeric values of the items in compact arrays and stores them as columns of a numpy .npz archive when closed.
+    the columns are paths in the item ("wgt", "articleCounts.total") or tuples (name, path[, type]). the type is "int", "float",
+    "date" (e.g. "2014-04-16", stored as the int 20140416, see dateToInt) or "time" ("12:34:56", stored as seconds since
+    midnight); if not given, it is determined from the first value (an int column changes to float if a float value appears).
+    missing values are stored as 0 (nan in float columns). numpy is needed only for close()
+    """
+    _datePattern = re.compile(r"^\d{4}-\d{2}-\d{2}")
+    _timePattern = re.compile(r"^\d{1,2}:\d{2}:\d{2}$")
+
+    def __init__(self, fileName, columns):
+        self._fileName = fileName
+        self._columns = _parseColumns(columns)
+        self._arrays = [self._createArray(type) for name, keys, type in self._columns]
+        self._missingCount = [0] * len(self._columns)      # number of missing values before the type of the column was known
+        self.itemCount = 0
+
+    def write(self, item):
+        for i, (name, keys, type) in enumerate(self._columns):
+            value = getItemValue(item, keys)
+            if type == None:
+                if value == None:
+                    self._missingCount[i] += 1
+                    continue
+                type = self._setType(i, value)
+            arr = self._arrays[i]
+            if value == None:
+                arr.append(float("nan") if type == "float" else 0)
+            elif type == "int":
+                if isinstance(value, float):
+                    # the column contains floats after all
+                    arr = self._arrays[i] = array("d", arr)
+                    self._columns[i] = (name, keys, "float")
+                arr.append(value)
+            elif type == "float":
+                arr.append(float(value))
+            elif type == "date":
+                arr.append(dateToInt(value))
+            else:
+                arr.append(timeToInt(value))
+        self.itemCount += 1
+
+    # write all the items of the response or iterable (see _iterResultItems). the items are not kept in memory
+    def writeAll(self, res):
+        for item in _iterResultItems(res):
+            self.write(item)
+
+    # store the columns to the file
+    def close(self):
+        np = _importNumpy()
+        columns = {}
+        for i, (name, keys, type) in enumerate(self._columns):
+            if type == None:
+                columns[name] = np.zeros(self.itemCount)
+            else:
+                columns[name] = np.frombuffer(self._arrays[i], dtype = self._arrays[i].typecode)
+        np.savez_compressed(self._fileName, **columns)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def _createArray(self, type):
+        return array("d" if type == "float" else "l") if type != None else None
+
+    # determine the type of the column from its first value
+    def _setType(self, i, value):
+        name, keys, type = self._columns[i]
+        if isinstance(value, (bool, int, long)):
+            type = "int"
+        elif isinstance(value, float):
+            type = "float"
+        elif isinstance(value, basestring) and self._datePattern.match(value):
+            type = "date"
+        elif isinstance(value, basestring) and self._timePattern.match(value):
+            type = "time"
+        else:
+            raise ValueError("The column %s doesn't contain numeric values (%r)" % (name, value))
+        self._columns[i] = (name, keys, type)
+        arr = self._arrays[i] = self._createArray(type)
+        arr.extend([float("nan") if type == "float" else 0] * self._missingCount[i])
+        return type
+
 class Query(object):
     def __init__(self):
         self.queryParams = {};
@@ -58,20 +700,124 @@ class Query(object):
     def clearRequestedResults(self):
         self.resultTypeList = [];
 
-    # encode the request. if the username and pass are also provided then add also them to the request parameters
+    # encode the request. if the username and pass are also provided then add also them to the request parameters.
+    # the queryParams of the query are not modified
     def _encode(self, erUsername = None, erPassword = None):
-        self._updateQueryParamsWithResultTypes();
+        params = self._getQueryParams();
         if erUsername != None and erPassword != None:
-            self.queryParams["erUsername"] = erUsername;
-            self.queryParams["erPassword"] = erPassword;
-        return urllib.urlencode(self.queryParams, True);
+            params["erUsername"] = erUsername;
+            params["erPassword"] = erPassword;
+        return urllib.urlencode(params, True);
+
+    # return the fingerprint of the query (see getRequestFingerprint)
+    def _getFingerprint(self):
+        return getRequestFingerprint(self._getPath(), self._getQueryParams())
+
+    # return the list of names of the requested result types
+    def _getResultTypes(self):
+        return [request.resultType for request in self.resultTypeList]
 
-    def _updateQueryParamsWithResultTypes(self):
+    # return a new dict with the query parameters and the parameters of the requested result types
+    def _getQueryParams(self):
         if len(self.resultTypeList) == 0:
             raise ValueError("The query does not have any result type specified. No sense in performing such a query");
+        params = dict(self.queryParams);
         for request in self.resultTypeList:
-            self.queryParams.update(request.__dict__);
-        self.queryParams["resultType"] = [request.__dict__["resultType"] for request in self.resultTypeList];
+            params.update(request.__dict__);
+        params["resultType"] = [request.__dict__["resultType"] for request in self.resultTypeList];
+        return params;
+
+
+# return a copy of the query parameters in which the lists are replaced with tuples, so that they can't be changed
+def _freezeParams(params):
+    return dict((key, tuple(copy.deepcopy(val)) if isinstance(val, list) else copy.deepcopy(val)) for key, val in params.iteritems())
+
+# the parameters of a query, shared by a QueryTemplate and all the templates bound from it. the parameters that are not
+# bound are encoded only once for each set of bound parameter names
+class _TemplateParams(object):
+    def __init__(self, params):
+        self.params = params
+        self._encoded = {}      # frozenset of the bound names -> encoded remaining params
+
+    def encode(self, boundNames):
+        encoded = self._encoded.get(boundNames)
+        if encoded == None:
+            encoded = urllib.urlencode(dict((key, val) for key, val in self.params.iteritems() if key not in boundNames), True)
+            if len(self._encoded) < 64:
+                self._encoded[boundNames] = encoded
+        return encoded
+
+
+# immutable snapshot of a query (QueryEvents, QueryArticles, ...) that can be executed like the query itself (execQuery, execQueries, ...).
+# the parameters are encoded once, and bind() returns a template in which only the given parameters (such as the page, dateStart
+# and dateEnd or the last activity id) are changed, so repeating the query with different values of a few parameters doesn't encode
+# all the other parameters again. a parameter bound to None is left out. templates with the same parameters are equal, so they
+# can be used as dict keys. changing the query after the template was created doesn't change the template
+class QueryTemplate(object):
+    def __init__(self, query):
+        self.__dict__.update(_path = query._getPath(), _resultTypes = tuple(query._getResultTypes()), _queryClass = type(query),
+                             _params = _TemplateParams(_freezeParams(query._getQueryParams())), _bound = {}, _boundNames = frozenset())
+
+    def __setattr__(self, name, val):
+        raise AttributeError("QueryTemplate can't be modified, use bind() to change its parameters")
+
+    # return a template with the parameters params changed (in addition to the parameters bound in this template)
+    def bind(self, **params):
+        template = object.__new__(QueryTemplate)
+        bound = dict(self._bound)
+        bound.update(_freezeParams(params))
+        template.__dict__.update(self.__dict__)
+        template.__dict__.update(_bound = bound, _boundNames = frozenset(bound))
+        template.__dict__.pop("_fingerprint", None)
+        return template
+
+    # return the value of the parameter (default if it is not set)
+    def getParam(self, name, default = None):
+        if name in self._bound:
+            val = self._bound[name]
+            return val if val != None else default
+        return self._params.params.get(name, default)
+
+    # return the class of the query that the template was created from
+    def getQueryClass(self):
+        return self._queryClass
+
+    def _getPath(self):
+        return self._path
+
+    def _getResultTypes(self):
+        return list(self._resultTypes)
+
+    def _getQueryParams(self):
+        params = dict(self._params.params)
+        for key, val in self._bound.iteritems():
+            if val != None:
+                params[key] = val
+            else:
+                params.pop(key, None)
+        return params
+
+    def _getFingerprint(self):
+        if "_fingerprint" not in self.__dict__:
+            self.__dict__["_fingerprint"] = getRequestFingerprint(self._path, self._getQueryParams())
+        return self.__dict__["_fingerprint"]
+
+    def _encode(self, erUsername = None, erPassword = None):
+        parts = [self._params.encode(self._boundNames)]
+        if self._bound:
+            parts.append(urllib.urlencode(dict((key, val) for key, val in self._bound.iteritems() if val != None), True))
+        if erUsername != None and erPassword != None:
+            parts.append(urllib.urlencode({ "erUsername": erUsername, "erPassword": erPassword }))
+        return "&".join([part for part in parts if part])
+
+    def __hash__(self):
+        return hash(self._getFingerprint())
+
+    def __eq__(self, other):
+        return isinstance(other, QueryTemplate) and self._getFingerprint() == other._getFingerprint()
+
+    def __ne__(self, other):
+        return not self == other
 
 
 class RequestBase(object):
@@ -873,53 +1619,1285 @@ class RequestArticlesRecentActivity(RequestArticles):
 # #####################################
 # #####################################
 
+# pool of persistent (keep-alive) http connections that is shared by all requests made through an EventRegistry instance
+# maxSize is the max number of idle connections that are kept open, maxPerHost the max number of connections
+# to a single host that can be in use at the same time (0 for no limit) and idleTimeout the number of seconds after which an unused connection is closed
+class ConnectionPool(object):
+    def __init__(self, maxSize = 10, maxPerHost = 4, idleTimeout = 60):
+        self._maxSize = maxSize
+        self._maxPerHost = maxPerHost
+        self._idleTimeout = idleTimeout
+        self._cond = threading.Condition()
+        self._idle = {}         # (scheme, host) -> list of (connection, time when the connection was returned to the pool)
+        self._inUse = {}        # (scheme, host) -> number of connections that are currently in use
+        self._created = 0       # number of new connections that were opened
+        self._reused = 0        # number of requests that were made on an already open connection
+        self._closed = 0        # number of connections that were closed
+
+    # return the max number of connections to a host that can be used at the same time (0 for no limit)
+    def getMaxPerHost(self):
+        return self._maxPerHost
+
+    # get a connection to the host. returns a tuple (connection, isReused). if all the connections to the host are in use,
+    # wait at most timeout seconds for one of them to be released and raise socket.timeout after that
+    def acquire(self, scheme, host, connClass, timeout = socket._GLOBAL_DEFAULT_TIMEOUT):
+        key = (scheme, host)
+        waitTimeout = timeout if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT else socket.getdefaulttimeout()
+        endTime = time.time() + waitTimeout if waitTimeout != None else None
+        with self._cond:
+            while self._maxPerHost > 0 and self._inUse.get(key, 0) >= self._maxPerHost:
+                if endTime == None:
+                    self._cond.wait()
+                    continue
+                remaining = endTime - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out waiting for a free connection to %s" % host)
+                self._cond.wait(remaining)
+            self._inUse[key] = self._inUse.get(key, 0) + 1
+            self._closeExpired()
+            idle = self._idle.get(key)
+            if idle:
+                conn = idle.pop()[0]
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                self._reused += 1
+                return conn, True
+            self._created += 1
+        return connClass(host, timeout = timeout), False
+
+    # return the connection to the pool. if the connection can't be reused (the response was not fully read,
+    # the server asked to close it or there was an error) then the connection is closed
+    def release(self, scheme, host, conn, reusable = True):
+        key = (scheme, host)
+        with self._cond:
+            self._inUse[key] -= 1
+            if reusable and conn.sock is not None and self._maxSize > 0:
+                self._idle.setdefault(key, []).append((conn, time.time()))
+                if sum(len(idle) for idle in self._idle.itervalues()) > self._maxSize:
+                    self._closeOldest()
+            else:
+                conn.close()
+                self._closed += 1
+            self._cond.notify_all()
+
+    # close all idle connections
+    def closeAll(self):
+        with self._cond:
+            for idle in self._idle.itervalues():
+                for conn, _ in idle:
+                    conn.close()
+                    self._closed += 1
+            self._idle = {}
+
+    # return the counters that show how the connections are being reused
+    def getStats(self):
+        with self._cond:
+            return { "created": self._created,
+                     "reused": self._reused,
+                     "closed": self._closed,
+                     "idle": sum(len(idle) for idle in self._idle.itervalues()),
+                     "inUse": sum(self._inUse.itervalues()) }
+
+    # close the connections that were not used in the last idleTimeout seconds. call only while holding the lock
+    def _closeExpired(self):
+        minTime = time.time() - self._idleTimeout
+        for key, idle in self._idle.items():
+            while idle and idle[0][1] < minTime:
+                idle.pop(0)[0].close()
+                self._closed += 1
+            if not idle:
+                del self._idle[key]
+
+    # close the connection that has been idle for the longest time. call only while holding the lock
+    def _closeOldest(self):
+        key = min((idle[0][1], key) for key, idle in self._idle.iteritems() if idle)[1]
+        self._idle[key].pop(0)[0].close()
+        self._closed += 1
+        if not self._idle[key]:
+            del self._idle[key]
+
+
+# file-like object for reading the response body. once the body is fully read, the connection is returned to the pool
+class _PooledResponseFile(object):
+    def __init__(self, pool, scheme, host, conn, resp):
+        self._pool = pool
+        self._scheme = scheme
+        self._host = host
+        self._conn = conn
+        self._resp = resp
+        self._buf = ""
+        if resp.isclosed():         # e.g. HEAD request or a response without a body
+            self._finish(True)
+
+    def read(self, amt = None):
+        data, self._buf = self._buf, ""
+        if amt is None:
+            return data + self._readResp(None)
+        if len(data) < amt:
+            data += self._readResp(amt - len(data))
+        elif len(data) > amt:
+            data, self._buf = data[:amt], data[amt:]
+        return data
+
+    def readline(self):
+        while "\n" not in self._buf:
+            chunk = self._readResp(8192)
+            if not chunk:
+                break
+            self._buf += chunk
+        pos = self._buf.find("\n") + 1 or len(self._buf)
+        line, self._buf = self._buf[:pos], self._buf[pos:]
+        return line
+
+    def close(self):
+        if self._resp is not None:
+            self._resp.close()
+            self._finish(False)     # unread data might still be waiting on the socket
+
+    def __del__(self):
+        self.close()
+
+    def _readResp(self, amt):
+        if self._resp is None:
+            return ""
+        try:
+            data = self._resp.read() if amt is None else self._resp.read(amt)
+        except:
+            self._resp.close()
+            self._finish(False)
+            raise
+        if self._resp.isclosed():
+            self._finish(True)
+        return data
+
+    def _finish(self, reusable):
+        self._resp = None
+        self._pool.release(self._scheme, self._host, self._conn, reusable)
+
+
+# url handler that makes http(s) requests on persistent connections obtained from a ConnectionPool
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    def __init__(self, pool, debuglevel = 0):
+        urllib2.HTTPSHandler.__init__(self, debuglevel)
+        self._pool = pool
+
+    def http_open(self, req):
+        return self._openPooled("http", httplib.HTTPConnection, req)
+
+    def https_open(self, req):
+        # requests tunneled through a proxy are made on a new connection
+        if req._tunnel_host:
+            return urllib2.HTTPSHandler.https_open(self, req)
+        return self._openPooled("https", httplib.HTTPSConnection, req)
+
+    def _openPooled(self, scheme, connClass, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items() if k not in headers))
+        headers["Connection"] = "keep-alive"
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        while True:
+            try:
+                conn, reused = self._pool.acquire(scheme, host, connClass, req.timeout)
+            except socket.timeout as err:
+                raise urllib2.URLError(err)
+            conn.set_debuglevel(self._debuglevel)
+            try:
+                conn.request(req.get_method(), req.get_selector(), req.data, headers)
+                resp = conn.getresponse(buffering = True)
+                break
+            except (socket.error, httplib.HTTPException) as err:
+                self._pool.release(scheme, host, conn, False)
+                # the server might have closed the idle connection in the meantime - in that case repeat the request on another connection
+                if not reused or isinstance(err, socket.timeout):
+                    raise urllib2.URLError(err)
+
+        fp = _PooledResponseFile(self._pool, scheme, host, conn, resp)
+        # error responses end up in exceptions that can be kept around for a long time. read their (short) body
+        # right away so that the connection doesn't stay checked out of the pool
+        if not (200 <= resp.status < 300):
+            fp = StringIO.StringIO(fp.read())
+        ret = urllib.addinfourl(fp, resp.msg, req.get_full_url())
+        ret.code = resp.status
+        ret.msg = resp.reason
+        return ret
+
+# base class for the caches of query responses. the responses expire after ttl seconds, where the ttl depends on the
+# requested result types (ttlByResultType, defaultTtl for the others). a query with several result types uses the
+# lowest of their ttls. results with a ttl of 0 (by default the recent activity) are never cached
+class ResponseCacheBase(object):
+    def __init__(self, defaultTtl = 15 * 60, ttlByResultType = None):
+        self._defaultTtl = defaultTtl
+        self._ttlByResultType = { "recentActivity": 0 }
+        self._ttlByResultType.update(ttlByResultType or {})
+
+    # return the number of seconds a response with the given result types can be cached
+    def getTtl(self, resultTypes):
+        return min([self._ttlByResultType.get(resultType, self._defaultTtl) for resultType in resultTypes] or [self._defaultTtl])
+
+    # return the cached response for the key or None if it is not in the cache (or it has expired)
+    def get(self, key):
+        raise NotImplementedError
+
+    # store the response (a string) for the key for ttl seconds. error responses (see isErrorResponse) are not stored
+    def put(self, key, response, ttl):
+        raise NotImplementedError
+
+
+# in-memory cache of the responses of the queries. the least recently used responses are removed when the cache
+# contains more than maxEntries responses or more than maxBytes bytes
+class ResponseCache(ResponseCacheBase):
+    def __init__(self, maxEntries = 1000, maxBytes = 50 * 1024 * 1024, defaultTtl = 15 * 60, ttlByResultType = None):
+        super(ResponseCache, self).__init__(defaultTtl, ttlByResultType)
+        self._maxEntries = maxEntries
+        self._maxBytes = maxBytes
+        self._entries = OrderedDict()       # key -> (response, expiration time), from the least to the most recently used
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry == None or entry[1] < time.time():
+                if entry != None:
+                    self._bytes -= len(entry[0])
+                self._misses += 1
+                return None
+            self._entries[key] = entry
+            self._hits += 1
+            return entry[0]
+
+    def put(self, key, response, ttl):
+        if ttl <= 0 or len(response) > self._maxBytes or isErrorResponse(response):
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old != None:
+                self._bytes -= len(old[0])
+            self._entries[key] = (response, time.time() + ttl)
+            self._bytes += len(response)
+            while len(self._entries) > self._maxEntries or self._bytes > self._maxBytes:
+                self._bytes -= len(self._entries.popitem(last = False)[1][0])
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    # return the hit/miss statistics and the current size of the cache
+    def getStats(self):
+        with self._lock:
+            return { "hits": self._hits,
+                     "misses": self._misses,
+                     "evictions": self._evictions,
+                     "entries": len(self._entries),
+                     "bytes": self._bytes }
+
+# cache of the responses stored in a SQLite database file. the file can be shared by several threads and processes that
+# read and write the cache at the same time. the responses are stored compressed. when the compressed responses take
+# more than maxBytes bytes, the least recently used ones are removed
+class DiskResponseCache(ResponseCacheBase):
+    def __init__(self, fileName, maxBytes = 1024 * 1024 * 1024, defaultTtl = 24 * 60 * 60, ttlByResultType = None, compressLevel = 6):
+        super(DiskResponseCache, self).__init__(defaultTtl, ttlByResultType)
+        self._fileName = fileName
+        self._maxBytes = maxBytes
+        self._compressLevel = compressLevel
+        self._threadData = threading.local()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        with self._transaction() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, data BLOB, size INTEGER, expires REAL, accessed REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            # the total size of the responses is kept up to date by the writers so that it doesn't have to be computed
+            conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY, bytes INTEGER)")
+            conn.execute("INSERT OR IGNORE INTO totals (id, bytes) VALUES (0, 0)")
+
+    def get(self, key):
+        conn = self._getConnection()
+        row = conn.execute("SELECT data, expires, accessed FROM responses WHERE key = ?", (key,)).fetchone()
+        now = time.time()
+        if row == None or row[1] < now:
+            with self._lock:
+                self._misses += 1
+            return None
+        # the access time is only used for eviction, so there is no need to write it on every read
+        if now - row[2] > 60:
+            with self._transaction() as conn:
+                conn.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        response = zlib.decompress(row[0])
+        # the file might contain error responses stored by the earlier versions, which are dropped
+        if isErrorResponse(response):
+            with self._transaction() as conn:
+                self._delete(conn, key)
+            with self._lock:
+                self._misses += 1
+            return None
+        with self._lock:
+            self._hits += 1
+        return response
+
+    def put(self, key, response, ttl):
+        if ttl <= 0 or isErrorResponse(response):
+            return
+        data = zlib.compress(response, self._compressLevel)
+        if len(data) > self._maxBytes:
+            return
+        now = time.time()
+        with self._transaction() as conn:
+            self._delete(conn, key)
+            conn.execute("INSERT INTO responses (key, data, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                         (key, sqlite3.Binary(data), len(data), now + ttl, now))
+            conn.execute("UPDATE totals SET bytes = bytes + ? WHERE id = 0", (len(data),))
+            if conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0] > self._maxBytes:
+                self._evict(conn)
+
+    # remove the expired responses and then the least recently used ones until the cache is at 90% of
+    # its max size (so that the eviction doesn't have to run again on the next write)
+    def _evict(self, conn):
+        removed = 0
+        for (key,) in conn.execute("SELECT key FROM responses WHERE expires < ?", (time.time(),)).fetchall():
+            removed += self._delete(conn, key)
+        size = conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+        if size > self._maxBytes * 0.9:
+            for key, entrySize in conn.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                if size <= self._maxBytes * 0.9:
+                    break
+                removed += self._delete(conn, key)
+                size -= entrySize
+        with self._lock:
+            self._evictions += removed
+
+    # delete the response for the key and update the total size. returns the number of deleted responses
+    def _delete(self, conn, key):
+        row = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row == None:
+            return 0
+        conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+        conn.execute("UPDATE totals SET bytes = bytes - ? WHERE id = 0", (row[0],))
+        return 1
+
+    def clear(self):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM responses")
+            conn.execute("UPDATE totals SET bytes = 0 WHERE id = 0")
+
+    def getStats(self):
+        conn = self._getConnection()
+        entries = conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        size = conn.execute("SELECT bytes FROM totals WHERE id = 0").fetchone()[0]
+        with self._lock:
+            return { "hits": self._hits,
+                     "misses": self._misses,
+                     "evictions": self._evictions,
+                     "entries": entries,
+                     "bytes": size }
+
+    # sqlite connections can't be shared by threads or inherited by forked processes - each thread of each process uses its own
+    def _getConnection(self):
+        conn = getattr(self._threadData, "conn", None)
+        if conn == None or self._threadData.pid != os.getpid():
+            conn = sqlite3.connect(self._fileName, timeout = 60, isolation_level = None)
+            conn.text_factory = str
+            # write-ahead logging allows reading the cache while another process is writing to it
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._threadData.conn = conn
+            self._threadData.pid = os.getpid()
+        return conn
+
+    # context manager for a write transaction. the database is locked for writing at the start of the transaction
+    # so that the reads made in the transaction are consistent with its writes
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._getConnection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+# write the data as json to the file. the data is written to a temporary file first, which then replaces the file,
+# so that the file is never left half-written
+def _writeJsonFile(fileName, data):
+    tmpFileName = fileName + ".tmp"
+    with open(tmpFileName, "w") as f:
+        json.dump(data, f)
+    if os.path.exists(fileName) and sys.platform == "win32":
+        os.remove(fileName)
+    os.rename(tmpFileName, fileName)
+
+# cache of the uris that best match the labels of concepts, locations, categories, ... the uris expire after ttl seconds.
+# when there are more than maxEntries uris, the ones that expire first are removed.
+# if fileName is set, the cache is loaded from the file and can be stored to it by calling save()
+class UriResolutionCache(object):
+    def __init__(self, ttl = 24 * 60 * 60, fileName = None, maxEntries = 100000):
+        self._ttl = ttl
+        self._fileName = fileName
+        self._maxEntries = maxEntries
+        self._entries = OrderedDict()   # json encoded key -> (uri, expiration time), ordered by the expiration time
+        self._lock = threading.Lock()
+        if fileName != None and os.path.exists(fileName):
+            with open(fileName) as f:
+                entries = sorted(json.load(f).iteritems(), key = lambda item: item[1][1])
+            self._entries = OrderedDict((key, tuple(val)) for key, val in entries)
+            with self._lock:
+                self._removeExpired()
+
+    def getFileName(self):
+        return self._fileName
+
+    # return a tuple (found, uri). the uri can be None if it is known that the label doesn't match any item
+    def get(self, key):
+        key = json.dumps(key)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry == None:
+                return False, None
+            if entry[1] < time.time():
+                self._removeExpired()
+                return False, None
+            return True, entry[0]
+
+    def set(self, key, uri):
+        key = json.dumps(key)
+        with self._lock:
+            # the entries are kept in the order of their expiration times
+            self._entries.pop(key, None)
+            self._entries[key] = (uri, time.time() + self._ttl)
+            self._removeExpired()
+
+    # store the cache (without the expired uris) to the file
+    def save(self):
+        now = time.time()
+        with self._lock:
+            entries = dict((key, val) for key, val in self._entries.iteritems() if val[1] >= now)
+        _writeJsonFile(self._fileName, entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries = OrderedDict()
+
+    # remove the expired entries and the entries over maxEntries. call only while holding the lock
+    def _removeExpired(self):
+        now = time.time()
+        while self._entries and (len(self._entries) > self._maxEntries or next(self._entries.itervalues())[1] < now):
+            self._entries.popitem(last = False)
+
+# token bucket that allows bursts of up to capacity requests and a sustained rate of rate requests per second
+class TokenBucket(object):
+    def __init__(self, rate, capacity = 1):
+        assert rate > 0 and capacity >= 1
+        self._rate = float(rate)
+        self._capacity = capacity
+        self._tokens = float(capacity)
+        self._lastTime = time.time()
+        self._lock = threading.Lock()
+
+    # take a token and return the number of seconds the caller has to wait before making the request.
+    # the token is taken even if it is not available yet so that concurrent callers are queued one after another
+    def reserve(self):
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self._capacity, self._tokens + (now - self._lastTime) * self._rate)
+            self._lastTime = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0
+            return -self._tokens / self._rate
+
+
+# raised when a request would exceed the daily number of requests allowed for the account
+class DailyQuotaExceeded(Exception):
+    pass
+
+
+# thread-safe limiter of the rate of requests. it combines a token bucket for all requests, optional token buckets for
+# individual endpoints (e.g. a separate budget for "/json/suggest" requests) and an optional daily quota for each account.
+# rate is the sustained number of requests per second (None for no limit) and burst the number of requests that can be made at once
+class RateLimiter(object):
+    def __init__(self, rate = 2, burst = 1, dailyQuota = None):
+        self._bucket = TokenBucket(rate, burst) if rate else None
+        self._endpointBuckets = {}      # path prefix -> TokenBucket
+        self._dailyQuota = dailyQuota   # max number of requests per day for an account (None for no limit)
+        self._quotaUsed = {}            # account -> (day, number of requests made on that day)
+        self._lock = threading.Lock()
+
+    # limit the rate of requests to the endpoints with paths that start with pathPrefix. the requests are still counted in the global limit
+    def setEndpointLimit(self, pathPrefix, rate, burst = 1):
+        self._endpointBuckets[pathPrefix] = TokenBucket(rate, burst)
+
+    # set the max number of requests per day (UTC) that can be made for an account (None for no limit)
+    def setDailyQuota(self, dailyQuota):
+        self._dailyQuota = dailyQuota
+
+    # return the number of requests that were made today for the account
+    def getQuotaUsage(self, account = None):
+        with self._lock:
+            day, count = self._quotaUsed.get(account, (None, 0))
+            return count if day == datetime.datetime.utcnow().date() else 0
+
+    # wait until the request to the path can be made. returns the number of seconds that were spent waiting
+    def acquire(self, path, account = None):
+        self._countRequest(account)
+        wait = self._bucket.reserve() if self._bucket != None else 0
+        prefixes = [prefix for prefix in self._endpointBuckets if path.startswith(prefix)]
+        if prefixes:
+            wait = max(wait, self._endpointBuckets[max(prefixes, key = len)].reserve())
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def _countRequest(self, account):
+        with self._lock:
+            today = datetime.datetime.utcnow().date()
+            day, count = self._quotaUsed.get(account, (today, 0))
+            if day != today:
+                count = 0
+            if self._dailyQuota != None and count >= self._dailyQuota:
+                raise DailyQuotaExceeded("The daily quota of %d requests has been used" % self._dailyQuota)
+            self._quotaUsed[account] = (today, count + 1)
+
+# result of an asynchronously executed request. result() waits until the request is completed
+class RequestFuture(object):
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._event.is_set()
+
+    # return the result of the request or raise the exception that the request failed with
+    def result(self, timeout = None):
+        if self.exception(timeout) != None:
+            raise self._exception
+        return self._result
+
+    # return the exception that the request failed with (None if it succeeded)
+    def exception(self, timeout = None):
+        if not self._event.wait(timeout):
+            raise RuntimeError("The request was not completed in %s seconds" % timeout)
+        return self._exception
+
+    # call fn(future) once the request is completed (immediately if it is already completed)
+    def addDoneCallback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _setResult(self, result, exception = None):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+# executes only one call for each key at a time. threads that make a call with the same key while the first call is in
+# progress wait for it and get its result (or exception) instead of making the call themselves
+class _SingleFlight(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}        # key -> RequestFuture of the call in progress
+
+    def call(self, key, func):
+        with self._lock:
+            future = self._calls.get(key)
+            isFirst = future == None
+            if isFirst:
+                future = self._calls[key] = RequestFuture()
+        if not isFirst:
+            return future.result()
+        try:
+            res = func()
+            future._setResult(res)
+            return res
+        except Exception as ex:
+            future._setResult(None, ex)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+
+# fixed set of daemon threads that execute the submitted calls
+class _WorkerPool(object):
+    def __init__(self, workers):
+        assert workers > 0
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target = self._work)
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    # schedule the call func(*args, **kwargs) and return a RequestFuture for its result
+    def submit(self, func, *args, **kwargs):
+        future = RequestFuture()
+        self._tasks.put((future, func, args, kwargs))
+        return future
+
+    # stop the worker threads once they complete the submitted calls. if cancelPending is True then
+    # the calls that have not been started yet are not executed and fail with an exception.
+    # if wait is True then block until the worker threads exit
+    def shutdown(self, cancelPending = False, wait = True):
+        if cancelPending:
+            while True:
+                try:
+                    task = self._tasks.get_nowait()
+                except Queue.Empty:
+                    break
+                if task != None:
+                    task[0]._setResult(None, RuntimeError("The request was cancelled"))
+        for t in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task == None:
+                return
+            future, func, args, kwargs = task
+            try:
+                future._setResult(func(*args, **kwargs))
+            except Exception as ex:
+                future._setResult(None, ex)
+
+
+# histogram with logarithmic buckets, used for the durations (in seconds) and sizes (in bytes) of the requests. the bucket i
+# contains the values in [minValue * factor ** i, minValue * factor ** (i + 1)), so the percentiles are accurate to about 20%
+class Histogram(object):
+    def __init__(self, minValue = 1e-5, factor = 2 ** 0.25, bucketCount = 128):
+        self._minValue = minValue
+        self._logFactor = math.log(factor)
+        self._factor = factor
+        self._buckets = [0] * bucketCount
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = 0
+        if value > self._minValue:
+            index = min(len(self._buckets) - 1, int(math.log(value / self._minValue) / self._logFactor))
+        self._buckets[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # return the upper bound of the bucket that contains the p-th percentile (0-100) of the values
+    def getPercentile(self, p):
+        if self.count == 0:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index, bucketCount in enumerate(self._buckets):
+            seen += bucketCount
+            if seen >= rank and bucketCount > 0:
+                return min(self.max, self._minValue * self._factor ** (index + 1))
+        return self.max
+
+    def getStats(self):
+        return { "count": self.count, "mean": self.sum / self.count if self.count else 0.0, "max": self.max,
+                 "p50": self.getPercentile(50), "p90": self.getPercentile(90), "p99": self.getPercentile(99) }
+
+
+# collects the measurements of the requests made by EventRegistry instances (see EventRegistry.setInstrumentation). for every
+# request there is a dict with the endpoint (path), the requested result types, the durations (in seconds) of the whole request
+# ("total"), of encoding the parameters ("encode"), waiting for the rate limiter ("rateLimitWait"), waiting for the response headers
+# ("network"), reading the response ("read") and parsing it ("decode"), the size of the response ("bytes"), the number of attempts,
+# the http status of the last attempt ("status"), the url and posted data ("url", "data"), whether it was answered from the cache
+# ("cacheHit") or by an identical concurrent request ("coalesced") and the exception (if it failed).
+# the durations and sizes are aggregated into histograms per endpoint and per result type. the callbacks are called with each dict.
+# an exception raised by a callback doesn't affect the request - it is only kept for getLastCallbackException
+class RequestInstrumentation(object):
+    metrics = ("total", "encode", "rateLimitWait", "network", "read", "decode", "bytes")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._lastCallbackException = None
+        self.reset()
+
+    def addCallback(self, callback):
+        self._callbacks.append(callback)
+
+    def removeCallback(self, callback):
+        self._callbacks.remove(callback)
+
+    def reset(self):
+        with self._lock:
+            self._stats = { "endpoint": {}, "resultType": {} }
+
+    def record(self, info):
+        with self._lock:
+            self._addToStats("endpoint", info["endpoint"], info)
+            for resultType in info["resultTypes"]:
+                self._addToStats("resultType", resultType, info)
+        for callback in self._callbacks:
+            try:
+                callback(info)
+            except Exception as ex:
+                self._lastCallbackException = ex
+
+    # the exception raised by the last callback that failed
+    def getLastCallbackException(self):
+        return self._lastCallbackException
+
+    # return the statistics grouped by "endpoint" or "resultType": { name: { "requests": ..., "failures": ..., "cacheHits": ...,
+    # "coalesced": ..., "retries": ..., "total": { "count": ..., "mean": ..., "p50": ..., ... }, "encode": { ... }, ... } }
+    def getStats(self, by = "endpoint"):
+        with self._lock:
+            stats = {}
+            for name, entry in self._stats[by].iteritems():
+                stats[name] = dict((key, val.getStats() if isinstance(val, Histogram) else val) for key, val in entry.iteritems())
+            return stats
+
+    # return the Histogram of the metric (see metrics) for the endpoint or result type
+    def getHistogram(self, name, metric, by = "endpoint"):
+        with self._lock:
+            return self._stats[by][name][metric]
+
+    def _addToStats(self, by, name, info):
+        entry = self._stats[by].get(name)
+        if entry == None:
+            entry = self._stats[by][name] = { "requests": 0, "failures": 0, "cacheHits": 0, "coalesced": 0, "retries": 0 }
+            for metric in self.metrics:
+                entry[metric] = Histogram(1, 2 ** 0.25, 128) if metric == "bytes" else Histogram()
+        entry["requests"] += 1
+        entry["failures"] += 1 if info["exception"] != None else 0
+        entry["cacheHits"] += 1 if info["cacheHit"] else 0
+        entry["coalesced"] += 1 if info["coalesced"] else 0
+        entry["retries"] += max(0, info["attempts"] - 1)
+        # only the requests that were actually made are included in the histograms of the individual steps
+        made = info["attempts"] > 0
+        for metric in self.metrics:
+            if metric == "total" or made:
+                entry[metric].add(info[metric])
+
+
+# writes a log of the requests made by EventRegistry instances (see the logging parameter of EventRegistry) into a file with one json
+# object per line: the time, endpoint, fingerprint of the parameters (see getRequestFingerprint), latency in seconds, http status,
+# response size, number of attempts, whether it was a cache hit and the error (if the request failed). the records are written by a
+# background thread in batches, so logging doesn't slow down the requests. if the queue of records is full (maxQueueSize), the records
+# are dropped (and counted in droppedCount) instead of blocking the requests. when the file exceeds maxBytes, it is renamed to
+# fileName.1 (the older files to fileName.2, ...) and a new file is started. at most backupCount old files are kept.
+# only one writer should write to a file. the EventRegistry instances created with logging = True share one writer per file
+class RequestLogWriter(object):
+    def __init__(self, fileName = "requests_log.txt", maxBytes = 10 * 1024 * 1024, backupCount = 3, maxQueueSize = 10000, flushInterval = 1):
+        self._fileName = fileName
+        self._maxBytes = maxBytes
+        self._backupCount = backupCount
+        self._flushInterval = flushInterval
+        self._queue = Queue.Queue(maxQueueSize)
+        self._lock = threading.Lock()
+        self._closed = False
+        self._users = 0                 # number of EventRegistry instances that use the writer
+        self.droppedCount = 0
+        self.writtenCount = 0
+        self._thread = threading.Thread(target = self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        _openRequestLogWriters.add(self)
+
+    # add the request with the measurements info (see RequestInstrumentation) to the log
+    def log(self, info):
+        if self._closed:
+            return
+        record = (time.time(), info["endpoint"], info.get("url"), info.get("data"), info["total"], info.get("status"),
+                  info["bytes"], info["attempts"], info["cacheHit"], info["exception"])
+        try:
+            self._queue.put_nowait(record)
+        except Queue.Full:
+            with self._lock:
+                self.droppedCount += 1
+
+    # write the queued records and stop the writing thread
+    def close(self, timeout = 5):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        _openRequestLogWriters.discard(self)
+        try:
+            self._queue.put(None, timeout = timeout)
+        except Queue.Full:
+            pass
+        self._thread.join(timeout)
+
+    # called by the EventRegistry instances that start using the writer
+    def _acquire(self):
+        with self._lock:
+            self._users += 1
+
+    # called by the EventRegistry instances that stop using the writer. the writer is closed when the last of them stops using it
+    def _release(self):
+        with _requestLogWritersLock:
+            with self._lock:
+                self._users -= 1
+                last = self._users <= 0
+            if last:
+                self.close()
+
+    def _run(self):
+        f = open(self._fileName, "a")
+        size = f.tell()
+        try:
+            while True:
+                try:
+                    records = [self._queue.get(timeout = self._flushInterval)]
+                except Queue.Empty:
+                    continue
+                # write all the queued records at once
+                while records[-1] != None and len(records) < 1000:
+                    try:
+                        records.append(self._queue.get_nowait())
+                    except Queue.Empty:
+                        break
+                done = records[-1] == None
+                lines = "".join([self._formatRecord(record) for record in records if record != None])
+                try:
+                    f.write(lines)
+                    f.flush()
+                    size += len(lines)
+                    self.writtenCount += len(records) - (1 if done else 0)
+                    if self._maxBytes != None and size >= self._maxBytes:
+                        f.close()
+                        self._rotate()
+                        f = open(self._fileName, "a")
+                        size = 0
+                except (IOError, OSError):
+                    with self._lock:
+                        self.droppedCount += len(records) - (1 if done else 0)
+                if done:
+                    return
+        finally:
+            f.close()
+
+    # the fingerprint (and other work that is not needed to make the request) is computed here, in the writing thread
+    def _formatRecord(self, record):
+        timestamp, endpoint, url, data, latency, status, size, attempts, cacheHit, ex = record
+        fingerprint = None
+        if url != None:
+            parts = urlparse.urlsplit(url)
+            fingerprint = getRequestFingerprint(endpoint, urlparse.parse_qs(data if data != None else parts.query, keep_blank_values = True))
+        return json.dumps({ "time": datetime.datetime.utcfromtimestamp(timestamp).isoformat() + "Z", "endpoint": endpoint,
+                            "fingerprint": fingerprint, "latency": round(latency, 6), "status": status, "bytes": size, "attempts": attempts,
+                            "cacheHit": cacheHit, "error": str(ex) if ex != None else None }) + "\n"
+
+    def _rotate(self):
+        if self._backupCount <= 0:
+            os.remove(self._fileName)
+            return
+        for i in range(self._backupCount - 1, 0, -1):
+            src = "%s.%d" % (self._fileName, i)
+            if os.path.exists(src):
+                dst = "%s.%d" % (self._fileName, i + 1)
+                if os.path.exists(dst):
+                    os.remove(dst)
+                os.rename(src, dst)
+        dst = self._fileName + ".1"
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.rename(self._fileName, dst)
+
+_requestLogWriters = {}                 # absolute file name -> RequestLogWriter shared by the EventRegistry instances
+_requestLogWritersLock = threading.Lock()
+_openRequestLogWriters = set()          # the writers that were not closed yet
+
+# return the shared RequestLogWriter for the file (creating it if needed) and register a new user of it
+def _acquireSharedRequestLogWriter(fileName):
+    key = os.path.abspath(fileName)
+    with _requestLogWritersLock:
+        writer = _requestLogWriters.get(key)
+        if writer == None or writer._closed:
+            writer = _requestLogWriters[key] = RequestLogWriter(fileName)
+        writer._acquire()
+        return writer
+
+# write the remaining records when the interpreter exits
+def _closeRequestLogWriters():
+    for writer in list(_openRequestLogWriters):
+        writer.close()
+
+atexit.register(_closeRequestLogWriters)
+
+
+# result of a single query executed by EventRegistry.execQueries
+class QueryResult(object):
+    def __init__(self, index, query, result = None, exception = None):
+        self.index = index              # position of the query in the list of executed queries
+        self.query = query
+        self.result = result            # the response (None if the query failed)
+        self.exception = exception      # the exception that the query failed with (None if it succeeded)
+
+    def succeeded(self):
+        return self.exception == None
+
+# incremental parser that extracts the items of lists in a json document that is received in chunks. paths are the paths
+# to the lists, e.g. "articles.results" for the list in { "articles": { "results": [...] } }, where * matches any key.
+# only the structure around the lists is scanned here, the items themselves are decoded by the (fast) json decoder
+class _JsonItemStreamer(object):
+    _specialRe = re.compile(r'[{}\[\],:"]')
+    _stringEndRe = re.compile(r'["\\]')
+    _whitespaceRe = re.compile(r"\s*")
+    _numberTailRe = re.compile(r"[0-9.eE+\-]*\Z")
+    _decoder = json.JSONDecoder()
+
+    def __init__(self, paths):
+        self._paths = [tuple(path.split(".")) for path in paths]
+        self._buf = ""
+        self._pos = 0
+        self._frames = []           # open containers: [bracket, current key (for objects), expecting a key (for objects), is a list with the items]
+        self._inString = False
+        self._keyStart = None       # position of the key that is currently being read
+        self._expectItem = False    # True if the next value is an item that should be returned
+        self._minItemLen = 0        # number of bytes that have to be available before trying to decode the item again
+        self._head = ""             # the start of the document, used to report an error response
+        self._itemCount = 0
+
+    # process the next chunk of the document (an empty chunk marks the end of it) and return the list of (path, item) that were completed
+    def feed(self, chunk):
+        if len(self._head) < 4096:
+            self._head += chunk[:4096 - len(self._head)]
+        final = not chunk
+        buf = self._buf + chunk
+        pos = self._pos
+        items = []
+        while True:
+            if self._inString:
+                m = self._stringEndRe.search(buf, pos)
+                if m == None:
+                    pos = len(buf)
+                    break
+                if m.group() == "\\":
+                    if m.end() >= len(buf):     # the escaped character is in the next chunk
+                        pos = m.start()
+                        break
+                    pos = m.end() + 1
+                    continue
+                pos = m.end()
+                self._inString = False
+                if self._keyStart != None:
+                    self._frames[-1][1] = json.loads(buf[self._keyStart:pos])
+                    self._keyStart = None
+                continue
+
+            if self._expectItem:
+                pos = self._whitespaceRe.match(buf, pos).end()
+                if pos >= len(buf):
+                    break
+                if buf[pos] != "]":
+                    if len(buf) - pos < self._minItemLen and not final:
+                        break
+                    try:
+                        item, end = self._decoder.raw_decode(buf, pos)
+                    except ValueError:
+                        end = None
+                    # a number at the end of the buffer might continue in the next chunk. the decoder stops before the
+                    # characters that don't form a valid number yet (e.g. "0." is decoded as 0), so they are checked too
+                    if end != None and not final and isinstance(item, (int, long, float)) and not isinstance(item, bool) and \
+                            self._numberTailRe.match(buf, end):
+                        end = len(buf)
+                    if end == None or (end >= len(buf) and not final):
+                        if final:
+                            raise ValueError("The response ended in the middle of an item")
+                        # try again when the available data doubles - that keeps the decoding time linear in the size of the item
+                        self._minItemLen = 2 * (len(buf) - pos)
+                        break
+                    items.append((tuple(frame[1] for frame in self._frames if frame[0] == "{"), item))
+                    self._itemCount += 1
+                    self._minItemLen = 0
+                    pos = end
+                self._expectItem = False
+                continue
+
+            m = self._specialRe.search(buf, pos)
+            if m == None:
+                pos = len(buf)
+                break
+            c = m.group()
+            pos = m.end()
+            frame = self._frames[-1] if self._frames else None
+            if c == '"':
+                self._inString = True
+                if frame != None and frame[0] == "{" and frame[2]:
+                    self._keyStart = m.start()
+            elif c == "{":
+                self._frames.append(["{", None, True, False])
+            elif c == "[":
+                isItemList = self._matches(tuple(frame[1] for frame in self._frames if frame[0] == "{"))
+                self._frames.append(["[", None, False, isItemList])
+                self._expectItem = isItemList
+            elif c in "}]":
+                self._frames.pop()
+            elif c == ",":
+                if frame[0] == "{":
+                    frame[2] = True
+                elif frame[3]:
+                    self._expectItem = True
+            elif c == ":":
+                frame[2] = False
+
+        # keep only the part of the document that was not processed yet
+        keep = self._keyStart if self._keyStart != None else pos
+        self._buf = buf[keep:]
+        self._pos = pos - keep
+        if self._keyStart != None:
+            self._keyStart = 0
+        if final and self._itemCount == 0:
+            self._raiseIfError()
+        return items
+
+    def _matches(self, path):
+        for pattern in self._paths:
+            if len(pattern) == len(path) and all(p == "*" or p == key for p, key in zip(pattern, path)):
+                return True
+        return False
+
+    # if the document is an error response then raise an exception with the error message
+    def _raiseIfError(self):
+        try:
+            res = json.loads(self._head)
+        except ValueError:
+            return
+        if isinstance(res, dict) and res.has_key("error"):
+            raise Exception(res["error"])
+
+# #####################################
+# #####################################
+
 # object that can access event registry 
 class EventRegistry(object):
-    def __init__(self, host = "http://eventregistry.org", logging = False, 
-                 minDelayBetweenRequests = 0.5,     # the minimum number of seconds between individual api calls
-                 repeatFailedRequestCount = -1):    # if a request fails (for example, because ER is down), what is the max number of times the request should be repeated (-1 for indefinitely)
+    def __init__(self, host = "http://eventregistry.org", 
+                 logging = False,                   # if True, the requests are logged to requests_log.txt. a RequestLogWriter can be given instead to log them elsewhere
+                 minDelayBetweenRequests = 0.5,     # the minimum number of seconds between individual api calls (ignored if rateLimiter is provided)
+                 rateLimiter = None,                # RateLimiter to use for the requests. can be shared by several EventRegistry instances
+                 repeatFailedRequestCount = -1,     # if a request fails (for example, because ER is down), what is the max number of times the request should be repeated (-1 for indefinitely)
+                 requestTimeout = 60,               # max number of seconds to wait for the response in a single attempt (None for no limit)
+                 requestDeadline = 600,             # max number of seconds for all attempts of a request together (None for no limit)
+                 retryBackoff = 1,                  # the wait before the first repeated attempt is random in [0, retryBackoff] seconds and then doubles with each attempt
+                 maxRetryBackoff = 60,              # max number of seconds to wait between two attempts
+                 connectionPoolSize = 10,           # max number of idle keep-alive connections to keep open (0 to open a new connection for each request)
+                 maxConnectionsPerHost = 4,         # max number of connections to the host that can be used at the same time
+                 connectionIdleTimeout = 60,        # number of seconds after which an unused keep-alive connection is closed
+                 responseCache = None,              # cache (ResponseCache or DiskResponseCache) for the responses of the queries (None for no caching)
+                 uriCache = None,                   # cache (UriResolutionCache) for the uris of concepts, locations, ... by default the uris are cached in memory for a day
+                 cacheUris = True,                  # set to False to resolve the labels without caching the uris
+                 maxUrlLength = 8000,               # queries that would result in longer urls are sent as POST requests
+                 coalesceRequests = False,          # if True, identical requests made at the same time by several threads are sent only once and all the threads get the same result (which they should not modify)
+                 instrumentation = None):           # RequestInstrumentation that collects the timings of the requests (None for no instrumentation)
         self.Host = host
-        self._lastException = None
-        self._logRequests = logging
+        self._threadData = threading.local()    # per-thread state, such as the last exception
+        self._requestLog = None
+        self.setLogging(logging)
         self._erUsername = None
         self._erPassword = None
-        self._minDelayBetweenRequests = minDelayBetweenRequests
         self._repeatFailedRequestCount = repeatFailedRequestCount
-        self._lastQueryTime = time.time()
+        self._requestTimeout = requestTimeout
+        self._requestDeadline = requestDeadline
+        self._retryBackoff = retryBackoff
+        self._maxRetryBackoff = maxRetryBackoff
+        self._attemptCallback = None
+        self._responseCache = responseCache
+        self._uriCache = None
+        if cacheUris:
+            self._uriCache = uriCache if uriCache != None else UriResolutionCache()
+        self._maxUrlLength = maxUrlLength
+        self._singleFlight = _SingleFlight() if coalesceRequests else None
+        self._instrumentation = instrumentation
+        if rateLimiter == None:
+            rateLimiter = RateLimiter(1.0 / minDelayBetweenRequests if minDelayBetweenRequests > 0 else None)
+        self._rateLimiter = rateLimiter
 
         cj = CookieJar()
-        self._reqOpener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj))
+        handlers = [urllib2.HTTPCookieProcessor(cj)]
+        self._connectionPool = None
+        if connectionPoolSize > 0:
+            self._connectionPool = ConnectionPool(connectionPoolSize, maxConnectionsPerHost, connectionIdleTimeout)
+            handlers.append(KeepAliveHandler(self._connectionPool))
+        self._reqOpener = urllib2.build_opener(*handlers)
 
         # if there is a settings.json file in the directory then try using it to login to ER
         currPath = os.path.split(__file__)[0]
-        if os.path.join(currPath, "settings.json"):
+        if os.path.exists(os.path.join(currPath, "settings.json")):
             settings = json.load(open(os.path.join(currPath, "settings.json")))
             self.login(settings.get("username", ""), settings.get("password", ""), False)
         
+    # the exception raised by the last request made in the current thread
+    @property
+    def _lastException(self):
+        return getattr(self._threadData, "lastException", None)
+
+    @_lastException.setter
+    def _lastException(self, ex):
+        self._threadData.lastException = ex
+
     # ensure that queries are not made too fast
-    def _sleepIfNecessary(self):
-        t = time.time();
-        if t - self._lastQueryTime < self._minDelayBetweenRequests:
-            time.sleep(self._minDelayBetweenRequests - (t - self._lastQueryTime))
-        self._lastQueryTime = t
-
-     # make the request - repeat it _repeatFailedRequestCount times, if they fail (indefinitely if _repeatFailedRequestCount = -1)
-    def _getUrlResponse(self, url, data = None):
+    def _sleepIfNecessary(self, path):
+        startTime = time.time()
+        self._rateLimiter.acquire(path, self._erUsername)
+        info = getattr(self._threadData, "requestInfo", None)
+        if info != None:
+            info["rateLimitWait"] += time.time() - startTime
+
+    # make the request - repeat it _repeatFailedRequestCount times, if they fail (indefinitely if _repeatFailedRequestCount = -1)
+    # only the errors that can go away (server errors, throttling, timeouts, network errors) are repeated, with an exponentially
+    # growing random wait between the attempts. if the request doesn't succeed, the exception of the last attempt is raised.
+    # if stream is True then the response is returned as a file-like object once its headers are received (and only errors up to that point are repeated).
+    # every attempt is rate limited as a request to the endpoint path (None if the request is not rate limited), since the server counts all of them
+    def _getUrlResponse(self, url, data = None, stream = False, path = None):
+        deadline = time.time() + self._requestDeadline if self._requestDeadline != None else None
         tryCount = 0
-        while self._repeatFailedRequestCount < 0 or tryCount < self._repeatFailedRequestCount:
+        while True:
             tryCount += 1
+            if path != None:
+                self._sleepIfNecessary(path)
+            timeout = self._requestTimeout
+            if deadline != None:
+                remaining = max(0.1, deadline - time.time())
+                timeout = remaining if timeout == None else min(timeout, remaining)
+            if timeout == None:
+                timeout = socket._GLOBAL_DEFAULT_TIMEOUT
+            startTime = time.time()
             try:
                 req = urllib2.Request(url, data)
-                respInfo = self._reqOpener.open(req).read()
+                respInfo = self._reqOpener.open(req, timeout = timeout)
+                openTime = time.time()
+                status = getattr(respInfo, "code", 200)
+                if not stream:
+                    respInfo = respInfo.read()
+                self._updateRequestInfo(tryCount, startTime, status, openTime, respInfo if not stream else None)
+                self._reportAttempt(url, tryCount, startTime, "ok")
                 return respInfo
             except Exception as ex:
+                excInfo = sys.exc_info()
+                self._updateRequestInfo(tryCount, startTime, getattr(ex, "code", None))
                 self._lastException = ex
-                print(ex)
-                time.sleep(5)   # sleep for 5 seconds on error
-        return None
+                delay = self._getRetryDelay(ex, tryCount)
+                if delay == None or (self._repeatFailedRequestCount >= 0 and tryCount >= self._repeatFailedRequestCount) or \
+                        (deadline != None and time.time() + delay >= deadline):
+                    self._reportAttempt(url, tryCount, startTime, "failed", ex)
+                    raise excInfo[0], excInfo[1], excInfo[2]
+                self._reportAttempt(url, tryCount, startTime, "retry", ex)
+                time.sleep(delay)
+
+    # return the number of seconds to wait before repeating the request that failed with the exception ex (None if it should not be repeated)
+    def _getRetryDelay(self, ex, tryCount):
+        retryAfter = 0
+        if isinstance(ex, urllib2.HTTPError):
+            # errors of the client (bad request, unauthorized, not found, ...) will not go away, except for timeouts and throttling
+            if ex.code < 500 and ex.code not in (408, 429):
+                return None
+            # respect the wait requested by the server
+            try:
+                retryAfter = float(ex.info().getheader("Retry-After", 0))
+            except (ValueError, TypeError, AttributeError):
+                pass
+        elif not isinstance(ex, (urllib2.URLError, socket.error, httplib.HTTPException)):
+            return None
+        # "full jitter" - a random wait prevents the clients from repeating the requests in lockstep
+        return max(retryAfter, random.uniform(0, min(self._maxRetryBackoff, self._retryBackoff * 2 ** (tryCount - 1))))
+
+    # add the timings of an attempt to the measurements of the request that the current thread is making (see _measureRequest)
+    def _updateRequestInfo(self, tryCount, startTime, status, openTime = None, respInfo = None):
+        info = getattr(self._threadData, "requestInfo", None)
+        if info == None:
+            return
+        info["attempts"] = tryCount
+        info["status"] = status
+        if openTime != None:
+            info["network"] += openTime - startTime
+            info["read"] += time.time() - openTime
+        if respInfo != None:
+            info["bytes"] = len(respInfo)
+
+    # measure the request made in the with block by the current thread and pass the measurements to the instrumentation.
+    # the with block gets the dict with the measurements (see RequestInstrumentation), to which it adds the times of its steps
+    @contextlib.contextmanager
+    def _measureRequest(self, path, resultTypes):
+        info = { "endpoint": path, "resultTypes": resultTypes, "cacheHit": False, "coalesced": False, "attempts": 0, "bytes": 0,
+                 "encode": 0.0, "rateLimitWait": 0.0, "network": 0.0, "read": 0.0, "decode": 0.0, "status": None,
+                 "url": None, "data": None, "exception": None }
+        prevInfo = getattr(self._threadData, "requestInfo", None)
+        self._threadData.requestInfo = info
+        startTime = time.time()
+        try:
+            yield info
+        except Exception as ex:
+            info["exception"] = ex
+            raise
+        finally:
+            self._threadData.requestInfo = prevInfo
+            info["total"] = time.time() - startTime
+            # the measurements must not change the outcome of the request
+            if self._instrumentation != None:
+                try:
+                    self._instrumentation.record(info)
+                except Exception:
+                    pass
+            if self._requestLog != None:
+                try:
+                    self._requestLog.log(info)
+                except Exception:
+                    pass
+
+    # report the outcome ("ok", "retry" or "failed") of a single attempt of a request to the attempt callback
+    def _reportAttempt(self, url, tryCount, startTime, outcome, ex = None):
+        if self._attemptCallback != None:
+            self._attemptCallback({ "url": url, "attempt": tryCount, "latency": time.time() - startTime, "outcome": outcome,
+                                    "status": getattr(ex, "code", None) if ex != None else 200, "exception": ex })
+
+    # set the function that is called after each attempt of a request. it is called with a dict containing the url, 
+    # the attempt number, the latency in seconds, the outcome ("ok", "retry" or "failed"), the http status and the exception (if any)
+    def setRequestAttemptCallback(self, callback):
+        self._attemptCallback = callback
+
+    # set logging to True to log the requests to requests_log.txt, to a RequestLogWriter to log them with it or to False to stop logging.
+    # the writer that is no longer used is closed, unless other EventRegistry instances still use it
+    def setLogging(self, val):
+        if isinstance(val, RequestLogWriter):
+            if val is self._requestLog:
+                return
+            val._acquire()
+            writer = val
+        elif val:
+            writer = _acquireSharedRequestLogWriter("requests_log.txt")
+            if writer is self._requestLog:
+                writer._release()
+                return
+        else:
+            writer = None
+        prevWriter, self._requestLog = self._requestLog, writer
+        if prevWriter != None:
+            prevWriter._release()
 
-    def setLogging(val):
-        self._logRequests = val
+    # return the RequestLogWriter used to log the requests (None if the requests are not logged)
+    def getRequestLog(self):
+        return self._requestLog
 
     def getLastException(self):
         return self._lastException
@@ -927,6 +2905,30 @@ class EventRegistry(object):
     def printLastException(self):
         print str(self._lastException)
 
+    # set the cache for the responses of the queries (None to disable caching)
+    def setResponseCache(self, responseCache):
+        self._responseCache = responseCache
+
+    def getResponseCache(self):
+        return self._responseCache
+
+    # return the RateLimiter used for the requests. use it to set per-endpoint limits or the daily quota
+    def getRateLimiter(self):
+        return self._rateLimiter
+
+    # set the RequestInstrumentation that collects the timings of the requests (None to disable the instrumentation)
+    def setInstrumentation(self, instrumentation):
+        self._instrumentation = instrumentation
+
+    def getInstrumentation(self):
+        return self._instrumentation
+
+    # return the counters of the keep-alive connection pool (number of created, reused, closed, idle and used connections)
+    def getConnectionPoolStats(self):
+        if self._connectionPool == None:
+            return None
+        return self._connectionPool.getStats()
+
     # login the user. without logging in, the user is limited to 10.000 queries per day. 
     # if you have a registered account, the number of allowed requests per day can be higher, depending on your subscription plan
     def login(self, username, password, throwExceptOnFailure = True):
@@ -941,7 +2943,6 @@ class EventRegistry(object):
 
     # make a get request
     def jsonRequest(self, methodUrl, paramDict):
-        self._sleepIfNecessary();
         self._lastException = None
 
         # add user credentials if specified
@@ -950,23 +2951,23 @@ class EventRegistry(object):
             paramDict["erPassword"] = self._erPassword
         
         try:
-            params = urllib.urlencode(paramDict, True)
-            url = self.Host + methodUrl + "?" + params
-            if self._logRequests:
-                with open("requests_log.txt", "a") as log:
-                    log.write(url + "\n")
-            # make the request
-            respInfo = self._getUrlResponse(url)
-            if respInfo != None:
-                respInfo = json.loads(respInfo)
-            return respInfo
+            with self._measureRequest(methodUrl, []) as info:
+                startTime = time.time()
+                params = urllib.urlencode(paramDict, True)
+                url = self.Host + methodUrl + "?" + params
+                info["encode"] = time.time() - startTime
+                info["url"] = url
+                def request():
+                    # make the request
+                    respInfo = self._getUrlResponse(url, path = methodUrl)
+                    return self._decodeResponse(respInfo, info)
+                return self._coalesce((url, None, True), request)
         except Exception as ex:
             self._lastException = ex;
             return None
 
     # make a post request where all parameters are encoded in the body - use for requests with many parameters
     def jsonPostRequest(self, methodUrl, paramDict):
-        self._sleepIfNecessary();
         self._lastException = None
 
         # add user credentials if specified
@@ -975,40 +2976,431 @@ class EventRegistry(object):
             paramDict["erPassword"] = self._erPassword
         
         try:
-            params = urllib.urlencode(paramDict, True)
-            url = self.Host + methodUrl
-            if self._logRequests:
-                with open("requests_log.txt", "a") as log:
-                    log.write(url + "\n")
-            # make the request
-            respInfo = self._getUrlResponse(url, params)
-            if respInfo != None:
-                respInfo = json.loads(respInfo)
-            return respInfo
+            with self._measureRequest(methodUrl, []) as info:
+                startTime = time.time()
+                params = urllib.urlencode(paramDict, True)
+                url = self.Host + methodUrl
+                info["encode"] = time.time() - startTime
+                info["url"], info["data"] = url, params
+                def request():
+                    # make the request
+                    respInfo = self._getUrlResponse(url, params, path = methodUrl)
+                    return self._decodeResponse(respInfo, info)
+                return self._coalesce((url, params, True), request)
         except Exception as ex:
             self._lastException = ex;
             return None
             
     # main method for executing the search queries. 
     def execQuery(self, query, convertToDict = True):
-        self._sleepIfNecessary();
         self._lastException = None
+        try:
+            return self._execQuery(query, convertToDict)
+        except Exception as ex:
+            self._lastException = ex
+            return None
 
+    # execute the query. unlike execQuery, the exception is raised if the request fails
+    def _execQuery(self, query, convertToDict = True, maxUrlLength = None):
+        with self._measureRequest(query._getPath(), query._getResultTypes()) as info:
+            # return the cached response if available. such queries are not counted in the rate limiting
+            cacheKey = None
+            if self._responseCache != None:
+                ttl = self._responseCache.getTtl(info["resultTypes"])
+                if ttl > 0:
+                    cacheKey = query._getFingerprint()
+                    respInfo = self._responseCache.get(cacheKey)
+                    if respInfo != None:
+                        info["cacheHit"] = True
+                        # the query is encoded only to compute the fingerprint in the log
+                        if self._requestLog != None:
+                            info["url"], info["data"] = self._getQueryUrl(query, maxUrlLength)
+                        return self._decodeResponse(respInfo, info) if convertToDict else respInfo
+
+            # the query is encoded only once and the same url and data are used in all the attempts
+            startTime = time.time()
+            url, data = self._getQueryUrl(query, maxUrlLength)
+            info["encode"] = time.time() - startTime
+            info["url"], info["data"] = url, data
+            def request():
+                # make the request
+                respInfo = self._getUrlResponse(url, data, path = query._getPath())
+                if respInfo != None and cacheKey != None:
+                    self._responseCache.put(cacheKey, respInfo, ttl)
+                return self._decodeResponse(respInfo, info) if convertToDict else respInfo
+            return self._coalesce((url, data, convertToDict), request)
+
+    # parse the json response and add the duration to the measurements of the request
+    def _decodeResponse(self, respInfo, info):
+        if respInfo == None:
+            return None
+        startTime = time.time()
+        respInfo = json.loads(respInfo)
+        info["decode"] += time.time() - startTime
+        return respInfo
+
+    # make the request by calling request(). if coalesceRequests is enabled, the threads that make a request with the same
+    # key while it is in progress wait for it and get the same result
+    def _coalesce(self, key, request):
+        if self._singleFlight == None:
+            return request()
+        called = []
+        def call():
+            called.append(True)
+            return request()
+        res = self._singleFlight.call(key, call)
+        info = getattr(self._threadData, "requestInfo", None)
+        if info != None and not called:
+            info["coalesced"] = True
+        return res
+
+    # return the url and the data (None for a GET request) of the request for the query. if the url with the encoded parameters
+    # would be longer than maxUrlLength (by default the maxUrlLength of the EventRegistry), the parameters are posted instead
+    def _getQueryUrl(self, query, maxUrlLength = None):
+        if maxUrlLength == None:
+            maxUrlLength = self._maxUrlLength
+        params = query._encode(self._erUsername, self._erPassword)
+        url = self.Host + query._getPath()
+        if maxUrlLength != None and len(url) + 1 + len(params) > maxUrlLength:
+            return url, params
+        return url + "?" + params, None
+
+    # execute the query and iterate over the items in the lists of results while the response is being downloaded. the response is parsed
+    # incrementally, so the memory use doesn't depend on the size of the response. resultPaths are the paths to the lists of items in the
+    # response, such as "articles.results" (by default the articles or events of QueryArticles or QueryEvents). * matches any key, e.g.
+    # "*.articles.results" for the articles of a QueryEvent with several event uris. if withPaths is True then tuples (path, item) are
+    # yielded, where path is the tuple of keys of the list that contains the item. the responses of streamed queries are not cached
+    def iterQueryResults(self, query, resultPaths = None, withPaths = False, chunkSize = 64 * 1024):
+        if resultPaths == None:
+            queryClass = query.getQueryClass() if isinstance(query, QueryTemplate) else type(query)
+            if issubclass(queryClass, QueryArticles):
+                resultPaths = ["articles.results"]
+            elif issubclass(queryClass, QueryEvents):
+                resultPaths = ["events.results"]
+            else:
+                raise ValueError("resultPaths have to be specified for queries of type %s" % queryClass.__name__)
+        # only the time until the response headers are received is measured
+        with self._measureRequest(query._getPath(), query._getResultTypes()) as info:
+            url, data = self._getQueryUrl(query)
+            info["url"], info["data"] = url, data
+            resp = self._getUrlResponse(url, data, stream = True, path = query._getPath())
+        streamer = _JsonItemStreamer(resultPaths)
+        try:
+            while True:
+                chunk = resp.read(chunkSize)
+                for path, item in streamer.feed(chunk):
+                    yield (path, item) if withPaths else item
+                if not chunk:
+                    break
+        finally:
+            resp.close()
+
+    # execute a list of queries (QueryEvents, QueryEvent, QueryArticles, QueryArticle) concurrently using the given number of worker threads.
+    # all requests share the same rate limiting and connection pool. returns a list of QueryResult objects in the same order as the queries.
+    # a failed query doesn't stop the others - its QueryResult holds the exception that it failed with
+    def execQueries(self, queries, workers = 4, convertToDict = True):
+        queries = list(queries)
+        results = [None] * len(queries)
+        for res in self.execQueriesAsCompleted(queries, workers, convertToDict):
+            results[res.index] = res
+        return results
+
+    # same as execQueries, but it yields the QueryResult objects in the order in which the queries complete
+    def execQueriesAsCompleted(self, queries, workers = 4, convertToDict = True):
+        queries = list(queries)
+        pool = _WorkerPool(workers)
+        completed = Queue.Queue()
+        try:
+            for index, query in enumerate(queries):
+                future = pool.submit(self._execQuery, query, convertToDict)
+                future.addDoneCallback(lambda future, index = index: completed.put((index, future)))
+            for i in range(len(queries)):
+                index, future = completed.get()
+                yield QueryResult(index, queries[index], future._result, future._exception)
+        finally:
+            pool.shutdown(cancelPending = True)
+
+    # execute a query with a (possibly long) list of event uris or article uris/ids by splitting the list into chunks that are executed in
+    # parallel. supported are QueryEvent, QueryArticle (including queryById and queryByUrl), QueryEvents with setEventUriList and
+    # QueryArticles with setArticleIdList. the results of the chunks are merged into a single dict: for QueryEvent and QueryArticle the
+    # per-uri results are joined, for QueryEvents and QueryArticles the lists of events/articles and uris/ids are concatenated (aggregates
+    # computed on parts of the list can't be merged and are not supported). chunkSize is the number of items per request - if None, the
+    # items are split evenly among the workers, with at most 100 items per request. chunks whose url would be longer than maxUrlLength
+    # are sent as POST requests (by default the maxUrlLength of the EventRegistry is used). like execQuery, it returns None if any of
+    # the chunks failed (see getLastException)
+    def execQueryInChunks(self, query, chunkSize = None, workers = 4, maxUrlLength = None):
+        self._lastException = None
         try:
-            params = query._encode(self._erUsername, self._erPassword)
-            url = self.Host + query._getPath() + "?" + params
-            if self._logRequests:
-                with open("requests_log.txt", "a") as log:
-                    log.write(url + "\n")
-            # make the request
-            respInfo = self._getUrlResponse(url)
-            if respInfo != None and convertToDict:
-                respInfo = json.loads(respInfo)
-            return respInfo
+            paramName, items, mergeLists = self._getChunkedParam(query)
+            if chunkSize == None:
+                chunkSize = min(100, max(1, (len(items) + workers - 1) / workers))
+            if mergeLists:
+                # all the events/articles of the chunk have to be returned in a single page
+                chunkSize = min(chunkSize, 200)
+            chunkQueries = [self._getChunkQuery(query, paramName, chunk, mergeLists) for chunk in self._splitIntoChunks(items, chunkSize)]
+            pool = _WorkerPool(min(workers, len(chunkQueries)))
+            try:
+                futures = [pool.submit(self._execChunkQuery, chunkQuery, maxUrlLength) for chunkQuery in chunkQueries]
+                merged = {}
+                for future in futures:
+                    res = future.result()
+                    if mergeLists:
+                        self._mergeListResults(merged, res)
+                    else:
+                        merged.update(res)
+                return merged
+            finally:
+                pool.shutdown(cancelPending = True)
         except Exception as ex:
             self._lastException = ex
             return None
 
+    # return the name of the query parameter with the list of items, the list itself and whether the results are lists that have to be
+    # concatenated (True) or dicts with results for individual items (False)
+    def _getChunkedParam(self, query):
+        if isinstance(query, QueryEvent):
+            names, mergeLists = ["eventUri"], False
+        elif isinstance(query, QueryArticle):
+            names, mergeLists = ["articleUri", "articleId", "articleUrl"], False
+        elif isinstance(query, QueryEvents):
+            names, mergeLists = ["eventUriList"], True
+        elif isinstance(query, QueryArticles):
+            names, mergeLists = ["articleIdList"], True
+        else:
+            raise ValueError("Queries of type %s can't be executed in chunks" % type(query).__name__)
+        for name in names:
+            items = query.queryParams.get(name)
+            if items in (None, "", []):
+                continue
+            if mergeLists:
+                items = items.split(",")
+            elif not isinstance(items, list):
+                items = [items]
+            if mergeLists:
+                unsupported = [resultType for resultType in query._getResultTypes() if resultType not in ("events", "articles", "uriList", "articleIds")]
+                if unsupported:
+                    raise ValueError("The results of type %s can't be computed in chunks" % ", ".join(unsupported))
+            return name, items, mergeLists
+        raise ValueError("The query doesn't contain a list of %s" % " or ".join(names))
+
+    # split the items into chunks of similar sizes with at most chunkSize items. when there is more than one item, every chunk gets at
+    # least two of them, so that the results are always returned in the same (per-item) format as for a list of items
+    def _splitIntoChunks(self, items, chunkSize):
+        chunkCount = (len(items) + chunkSize - 1) / chunkSize
+        if len(items) > 1:
+            chunkCount = min(chunkCount, len(items) / 2)
+        chunkCount = max(1, chunkCount)
+        return [items[i * len(items) / chunkCount : (i + 1) * len(items) / chunkCount] for i in range(chunkCount)]
+
+    # return a copy of the query that is limited to the given chunk of items
+    def _getChunkQuery(self, query, paramName, chunk, mergeLists):
+        chunkQuery = copy.copy(query)
+        chunkQuery.queryParams = dict(query.queryParams)
+        chunkQuery.queryParams[paramName] = ",".join(chunk) if mergeLists else chunk
+        if mergeLists:
+            chunkQuery.resultTypeList = []
+            for request in query.resultTypeList:
+                if isinstance(request, (RequestEventsInfo, RequestArticlesInfo)):
+                    request = copy.copy(request)
+                    request.setPage(0)
+                    request.setCount(len(chunk))
+                chunkQuery.resultTypeList.append(request)
+        return chunkQuery
+
+    # execute the query of a single chunk
+    def _execChunkQuery(self, query, maxUrlLength):
+        res = self._execQuery(query, maxUrlLength = maxUrlLength)
+        if "error" in res:
+            raise Exception(res["error"])
+        return res
+
+    # add the results of a chunk of a QueryEvents or QueryArticles to the merged results. lists are concatenated and the result counts summed
+    def _mergeListResults(self, merged, res):
+        for key, val in res.iteritems():
+            if key not in merged:
+                merged[key] = val
+            elif isinstance(val, list):
+                merged[key].extend(val)
+            elif isinstance(val, dict):
+                self._mergeListResults(merged[key], val)
+            elif key in ("resultCount", "totalResults"):
+                merged[key] += val
+
+    # iterate over all the articles that match the query (QueryArticles). the articles are obtained in pages of pageSize articles.
+    # the settings of the query's RequestArticlesInfo (sorting, returned info, ...) are used, while its other requested results are ignored.
+    # prefetch is the number of following pages that are downloaded in parallel while the caller is processing the current page.
+    # maxItems limits the number of returned articles (None for all)
+    def iterArticles(self, query, pageSize = 200, prefetch = 2, maxItems = None):
+        assert isinstance(query, QueryArticles)
+        return self._iterPages(query, RequestArticlesInfo, "articles", pageSize, prefetch, maxItems)
+
+    # iterate over all the events that match the query (QueryEvents). see iterArticles for the description of the arguments
+    def iterEvents(self, query, pageSize = 200, prefetch = 2, maxItems = None):
+        assert isinstance(query, QueryEvents)
+        return self._iterPages(query, RequestEventsInfo, "events", pageSize, prefetch, maxItems)
+
+    # return a template of the query that requests only the results of requestClass in pages of pageSize results (see _getPage)
+    def _getPageTemplate(self, query, requestClass, pageSize):
+        request = next((request for request in query.resultTypeList if isinstance(request, requestClass)), None)
+        request = copy.copy(request) if request != None else requestClass()
+        request.setPage(0)
+        request.setCount(pageSize)
+        pageQuery = copy.copy(query)
+        pageQuery.queryParams = dict(query.queryParams)
+        pageQuery.resultTypeList = [request]
+        return QueryTemplate(pageQuery)
+
+    # execute the page template with the given page and return the result under resultKey ({ "resultCount": ..., "results": [...] })
+    def _getPage(self, template, resultKey, page):
+        res = self._execQuery(template.bind(**{ resultKey + "Page": page }))
+        if resultKey not in res:
+            raise Exception(res.get("error", "The response doesn't contain the %s" % resultKey))
+        return res[resultKey]
+
+    def _iterPages(self, query, requestClass, resultKey, pageSize, prefetch, maxItems):
+        template = self._getPageTemplate(query, requestClass, pageSize)
+        first = self._getPage(template, resultKey, 0)
+        resultCount = first.get("resultCount", 0)
+        if maxItems != None:
+            resultCount = min(resultCount, maxItems)
+        pageCount = (resultCount + pageSize - 1) / pageSize
+        pool = _WorkerPool(prefetch) if prefetch > 0 and pageCount > 1 else None
+        pending = deque()
+        nextPage = 1
+        itemCount = 0
+        try:
+            page = first
+            while True:
+                # keep downloading the following pages while the current one is being processed
+                while pool != None and nextPage < pageCount and len(pending) < prefetch:
+                    pending.append(pool.submit(self._getPage, template, resultKey, nextPage))
+                    nextPage += 1
+                for item in page.get("results", []):
+                    if itemCount >= resultCount:
+                        return
+                    itemCount += 1
+                    yield item
+                if pending:
+                    page = pending.popleft().result()
+                elif nextPage < pageCount:
+                    page = self._getPage(template, resultKey, nextPage)
+                    nextPage += 1
+                else:
+                    return
+        finally:
+            if pool != None:
+                pool.shutdown(cancelPending = True)
+
+    # export all the articles that match the query (QueryArticles). the date range of the query is split into shards with similar
+    # numbers of articles (see getDateShards) and the shards are downloaded in parallel by the workers, each page by page. the articles
+    # are yielded as the pages arrive, so they are not sorted. a shard whose page can't be downloaded is repeated from that page up to
+    # maxShardRetries times (the other shards continue meanwhile), after that the exception is raised
+    def exportArticles(self, query, workers = 4, shardSize = 5000, pageSize = 200, maxShardRetries = 3):
+        assert isinstance(query, QueryArticles)
+        return self._exportShards(query, RequestArticlesInfo, "articles", workers, shardSize, pageSize, maxShardRetries)
+
+    # export all the events that match the query (QueryEvents). see exportArticles
+    def exportEvents(self, query, workers = 4, shardSize = 5000, pageSize = 200, maxShardRetries = 3):
+        assert isinstance(query, QueryEvents)
+        return self._exportShards(query, RequestEventsInfo, "events", workers, shardSize, pageSize, maxShardRetries)
+
+    # split the date range of the query (QueryArticles or QueryEvents) into shards with about shardSize results each (but at least
+    # minShards shards, if there are enough dates). the numbers of results per date are obtained with RequestArticlesTimeAggr or
+    # RequestEventsTimeAggr. returns a list of (dateStart, dateEnd) tuples that cover the date range without gaps. the dates are inclusive
+    # and None means the date limit of the query itself (used for the start of the first shard and the end of the last one)
+    def getDateShards(self, query, shardSize = 5000, minShards = 1):
+        aggrQuery = copy.copy(query)
+        aggrQuery.resultTypeList = [RequestArticlesTimeAggr() if isinstance(query, QueryArticles) else RequestEventsTimeAggr()]
+        res = self._execQuery(aggrQuery)
+        if "timeAggr" not in res:
+            raise Exception(res.get("error", "The response doesn't contain the timeAggr"))
+        items = sorted((item for item in _getDateItems(res, "timeAggr") if item["count"] > 0), key = lambda item: item["date"])
+        total = sum(item["count"] for item in items)
+        shardCount = min(len(items), max(minShards, (total + shardSize - 1) / shardSize))
+        shards = []
+        dateStart = None
+        count = 0
+        for item in items[:-1]:
+            count += item["count"]
+            # end the shard once the shards so far contain their share of the results
+            if len(shards) < shardCount - 1 and count >= total * (len(shards) + 1) / float(shardCount):
+                date = datetime.datetime.strptime(item["date"][:10], "%Y-%m-%d").date()
+                shards.append((dateStart, date.isoformat()))
+                dateStart = (date + datetime.timedelta(days = 1)).isoformat()
+        shards.append((dateStart, None))
+        return shards
+
+    def _exportShards(self, query, requestClass, resultKey, workers, shardSize, pageSize, maxShardRetries):
+        shards = self.getDateShards(query, shardSize, workers)
+        for shardIndex, page, pageCount, items in self._iterShardPages(query, requestClass, resultKey, shards, [0] * len(shards), workers, pageSize, maxShardRetries):
+            for item in items:
+                yield item
+
+    # download the pages of the date shards of the query in parallel, starting with the page startPages[i] in the shard i. yields
+    # tuples (shardIndex, page, pageCount, items) in the order in which the pages arrive; the pages of a shard arrive in order
+    def _iterShardPages(self, query, requestClass, resultKey, shards, startPages, workers, pageSize, maxShardRetries):
+        # the queue is bounded so that the downloads don't get too far ahead of the caller
+        pages = Queue.Queue(2 * workers)
+        stopped = threading.Event()
+
+        def put(entry):
+            while not stopped.is_set():
+                try:
+                    pages.put(entry, timeout = 0.1)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        template = self._getPageTemplate(query, requestClass, pageSize)
+        def exportShardPages(shardIndex, dateStart, dateEnd, page):
+            dates = {}
+            if dateStart != None:
+                dates["dateStart"] = dateStart
+            if dateEnd != None:
+                dates["dateEnd"] = dateEnd
+            shardTemplate = template.bind(**dates)
+            pageCount, failCount = page + 1, 0
+            while page < pageCount and not stopped.is_set():
+                try:
+                    res = self._getPage(shardTemplate, resultKey, page)
+                except Exception as ex:
+                    failCount += 1
+                    if failCount > maxShardRetries:
+                        put(("error", ex))
+                        return
+                    stopped.wait(min(self._maxRetryBackoff, self._retryBackoff * 2 ** failCount))
+                    continue
+                pageCount = (res.get("resultCount", 0) + pageSize - 1) / pageSize
+                if not put(("page", (shardIndex, page, pageCount, res.get("results", [])))):
+                    return
+                page += 1
+            put(("done", None))
+
+        # any failure of a worker is passed to the caller, which would otherwise wait for the shard forever
+        def exportShard(shardIndex, dateStart, dateEnd, page):
+            try:
+                exportShardPages(shardIndex, dateStart, dateEnd, page)
+            except Exception as ex:
+                put(("error", ex))
+
+        pool = _WorkerPool(max(1, min(workers, len(shards))))
+        try:
+            for shardIndex, (dateStart, dateEnd) in enumerate(shards):
+                pool.submit(exportShard, shardIndex, dateStart, dateEnd, startPages[shardIndex])
+            remaining = len(shards)
+            while remaining > 0:
+                kind, val = pages.get()
+                if kind == "error":
+                    raise val
+                if kind == "done":
+                    remaining -= 1
+                    continue
+                yield val
+        finally:
+            stopped.set()
+            pool.shutdown(cancelPending = True)
+
     # return a list of concepts that contain the given prefix
     # valid sources: person, loc, org, wiki, entities (== person + loc + org), concepts (== entities + wiki), conceptClass, conceptFolder
     # fullLocInfo determines if you wish to see as label "city, country" or just "city"
@@ -1033,38 +3425,71 @@ class EventRegistry(object):
         
     # return a concept uri that is the best match for the given concept label
     def getConceptUri(self, conceptLabel, lang = "eng", sources = ["concepts"]):
-        matches = self.suggestConcepts(conceptLabel, lang = lang, sources = sources)
-        if matches != None and len(matches) > 0 and matches[0].has_key("uri"):
-            return matches[0]["uri"]
-        return None
+        return self._getFirstMatchUri(("concept", conceptLabel, lang, sources),
+                                      lambda: self.suggestConcepts(conceptLabel, lang = lang, sources = sources))
 
     # return a location uri that is the best match for the given location label
     def getLocationUri(self, locationLabel, lang = "eng"):
-        matches = self.suggestConcepts(locationLabel, sources = ["loc"], lang = lang, fullLocInfo = True);
-        if matches != None and len(matches) > 0 and matches[0].has_key("uri"):
-            return matches[0]["uri"]
-        return None;
+        return self._getFirstMatchUri(("location", locationLabel, lang),
+                                      lambda: self.suggestConcepts(locationLabel, sources = ["loc"], lang = lang, fullLocInfo = True))
 
     # return a category uri that is the best match for the given label
     def getCategoryUri(self, categoryLabel):
-        matches = self.suggestCategories(categoryLabel);
-        if matches != None and len(matches) > 0 and matches[0].has_key("uri"):
-            return matches[0]["uri"]
-        return None;
+        return self._getFirstMatchUri(("category", categoryLabel), lambda: self.suggestCategories(categoryLabel))
 
     # return the news source that best matches the source name
     def getNewsSourceUri(self, sourceName):
-        matches = self.suggestNewsSources(sourceName);
-        if matches != None and len(matches) > 0 and matches[0].has_key("uri"):
-            return matches[0]["uri"]
-        return None;
+        return self._getFirstMatchUri(("source", sourceName), lambda: self.suggestNewsSources(sourceName))
     
     # return a uri of the concept class that is the best match for the given label
     def getConceptClass(self, classLabel, lang = "eng"):
-        matches = self.suggestConceptClasses(classLabel, lang = lang)
+        return self._getFirstMatchUri(("conceptClass", classLabel, lang), lambda: self.suggestConceptClasses(classLabel, lang = lang))
+
+    # return a dict that maps each of the concept labels to the uri of the best matching concept (None if there is no match).
+    # the labels that are not in the uri cache are resolved concurrently using the given number of worker threads
+    def resolveConceptUris(self, conceptLabels, lang = "eng", sources = ["concepts"], workers = 4):
+        uris = {}
+        missing = []
+        for label in set(conceptLabels):
+            found, uri = self._uriCache.get(("concept", label, lang, sources)) if self._uriCache != None else (False, None)
+            if found:
+                uris[label] = uri
+            else:
+                missing.append(label)
+        if missing:
+            pool = _WorkerPool(min(workers, len(missing)))
+            try:
+                futures = [(label, pool.submit(self.getConceptUri, label, lang, sources)) for label in missing]
+                for label, future in futures:
+                    uris[label] = future.result()
+            finally:
+                pool.shutdown(cancelPending = True)
+            if self._uriCache != None and self._uriCache.getFileName() != None:
+                self._uriCache.save()
+        return uris
+
+    # return the uri of the first item returned by the suggest function. the uris are cached in the uri cache under the cacheKey
+    def _getFirstMatchUri(self, cacheKey, suggest):
+        if self._uriCache != None:
+            found, uri = self._uriCache.get(cacheKey)
+            if found:
+                self._lastException = None
+                return uri
+        matches = suggest()
+        uri = None
         if matches != None and len(matches) > 0 and matches[0].has_key("uri"):
-            return matches[0]["uri"]
-        return None    
+            uri = matches[0]["uri"]
+        # don't cache the result of a failed request
+        if matches != None and self._uriCache != None:
+            self._uriCache.set(cacheKey, uri)
+        return uri
+
+    # set the cache (UriResolutionCache) for the uris returned by getConceptUri, getLocationUri, ... (None to disable caching)
+    def setUriCache(self, uriCache):
+        self._uriCache = uriCache
+
+    def getUriCache(self):
+        return self._uriCache
 
     ### return info about recently modified events
     # maxEventCount determines the maximum number of events to return in a single call (max 250)
@@ -1119,3 +3544,338 @@ class EventRegistry(object):
     # get some stats about recently imported articles and events
     def getRecentStats(self):
         return self.jsonRequest("/json/overview", { "action": "getRecentStats"})
+
+
+# non-blocking access to event registry. every method returns immediately with a RequestFuture while the
+# request is made on one of the worker threads. use future.result() to wait for the response or
+# future.addDoneCallback(fn) to be notified when it arrives. if the request fails, the future holds the exception.
+# the requests are made through the given EventRegistry instance so they share its login, rate limiting and connection pool.
+# by default there are as many workers as the connections to the host that the connection pool allows (maxConnectionsPerHost)
+class AsyncEventRegistry(object):
+    def __init__(self, eventRegistry, workers = None):
+        if workers == None:
+            pool = eventRegistry._connectionPool
+            workers = pool.getMaxPerHost() if pool != None and pool.getMaxPerHost() > 0 else 4
+        self._er = eventRegistry
+        self._pool = _WorkerPool(workers)
+
+    # stop the worker threads. the requests that were already submitted are still completed
+    def close(self):
+        self._pool.shutdown()
+
+    def execQuery(self, query, convertToDict = True):
+        return self._pool.submit(self._er._execQuery, query, convertToDict)
+
+    def jsonRequest(self, methodUrl, paramDict):
+        return self._submit(self._er.jsonRequest, methodUrl, paramDict)
+
+    def jsonPostRequest(self, methodUrl, paramDict):
+        return self._submit(self._er.jsonPostRequest, methodUrl, paramDict)
+
+    def suggestConcepts(self, *args, **kwargs):
+        return self._submit(self._er.suggestConcepts, *args, **kwargs)
+
+    def suggestNewsSources(self, *args, **kwargs):
+        return self._submit(self._er.suggestNewsSources, *args, **kwargs)
+
+    def suggestLocations(self, *args, **kwargs):
+        return self._submit(self._er.suggestLocations, *args, **kwargs)
+
+    def suggestCategories(self, *args, **kwargs):
+        return self._submit(self._er.suggestCategories, *args, **kwargs)
+
+    def suggestConceptClasses(self, *args, **kwargs):
+        return self._submit(self._er.suggestConceptClasses, *args, **kwargs)
+
+    def getConceptUri(self, *args, **kwargs):
+        return self._submit(self._er.getConceptUri, *args, **kwargs)
+
+    def getLocationUri(self, *args, **kwargs):
+        return self._submit(self._er.getLocationUri, *args, **kwargs)
+
+    def getCategoryUri(self, *args, **kwargs):
+        return self._submit(self._er.getCategoryUri, *args, **kwargs)
+
+    def getNewsSourceUri(self, *args, **kwargs):
+        return self._submit(self._er.getNewsSourceUri, *args, **kwargs)
+
+    def getConceptClass(self, *args, **kwargs):
+        return self._submit(self._er.getConceptClass, *args, **kwargs)
+
+    def getRecentEvents(self, *args, **kwargs):
+        return self._submit(self._er.getRecentEvents, *args, **kwargs)
+
+    def getRecentArticles(self, *args, **kwargs):
+        return self._submit(self._er.getRecentArticles, *args, **kwargs)
+
+    def getRecentStats(self):
+        return self._submit(self._er.getRecentStats)
+
+    # run the EventRegistry method on a worker thread. the methods report errors by returning None and
+    # setting the last exception of the thread - turn that into an exception of the future
+    def _submit(self, method, *args, **kwargs):
+        def call():
+            # the exception of an earlier call made in the same worker thread must not be mistaken for the exception of this one
+            self._er._lastException = None
+            res = method(*args, **kwargs)
+            if res == None and self._er._lastException != None:
+                raise self._er._lastException
+            return res
+        return self._pool.submit(call)
+
+
+# continuous stream of the recently added articles or recently updated events. the poller keeps track of the lastActivityId,
+# skips the items that were already returned and adapts the polling interval to the rate at which new items arrive.
+# kind is "articles" or "events". if query (QueryArticles or QueryEvents) is given then only the activity matching the query is
+# returned (RequestArticlesRecentActivity / RequestEventsRecentActivity), otherwise all the activity (getRecentArticles / getRecentEvents).
+# kwargs are passed to these requests (e.g. includeArticleBody = False). if checkpointFile is set, the lastActivityId and the ids of
+# the recently returned items are stored to it after each batch of items was processed, so that a restarted poller continues where
+# the previous one stopped instead of downloading the whole maxMinsBack window again
+class RecentActivityPoller(object):
+    def __init__(self, eventRegistry, kind = "articles", query = None,
+                 maxItemCount = 200,            # max number of items to return in a single call
+                 maxMinsBack = 10 * 60,         # how far back to look when there is no lastActivityId yet
+                 minInterval = 10,              # min number of seconds between two calls
+                 maxInterval = 5 * 60,          # max number of seconds between two calls
+                 checkpointFile = None,
+                 maxSeenItems = 10000,          # number of most recently returned item ids that are remembered to skip duplicates
+                 **kwargs):
+        assert kind in ("articles", "events")
+        assert maxItemCount <= 1000
+        self._er = eventRegistry
+        self._kind = kind
+        self._template = None
+        if query != None:
+            # the query is encoded once and only the last activity id is changed in the calls
+            query = copy.copy(query)
+            if kind == "articles":
+                query.resultTypeList = [RequestArticlesRecentActivity(maxArticleCount = maxItemCount, maxMinsBack = maxMinsBack, **kwargs)]
+            else:
+                query.resultTypeList = [RequestEventsRecentActivity(maxEventCount = maxItemCount, maxMinsBack = maxMinsBack, **kwargs)]
+            self._template = QueryTemplate(query)
+        self._maxItemCount = maxItemCount
+        self._maxMinsBack = maxMinsBack
+        self._minInterval = minInterval
+        self._maxInterval = maxInterval
+        self._checkpointFile = checkpointFile
+        self._maxSeenItems = maxSeenItems
+        self._kwargs = kwargs
+        self._lastActivityId = 0
+        self._seen = OrderedDict()
+        self._pending = deque()         # new items that were not returned by iterItems yet
+        self._interval = minInterval
+        self._itemRate = None           # estimated number of new items per second
+        self._lastPollTime = None
+        self._stopEvent = threading.Event()
+        self._lastException = None
+        if checkpointFile != None and os.path.exists(checkpointFile):
+            with open(checkpointFile) as f:
+                checkpoint = json.load(f)
+            self._lastActivityId = checkpoint.get("lastActivityId", 0)
+            for id in checkpoint.get("seen", []):
+                self._seen[id] = True
+
+    def getLastActivityId(self):
+        return self._lastActivityId
+
+    # number of seconds that iterItems will wait before the next call
+    def getInterval(self):
+        return self._interval
+
+    # the exception raised by the last failed call (the polling is repeated after maxInterval seconds)
+    def getLastException(self):
+        return self._lastException
+
+    # make a single call and return the list of new items. the state is updated, but the checkpoint is not saved
+    def poll(self):
+        activity = self._getActivity()
+        self._lastActivityId = activity.get("lastActivityId", self._lastActivityId)
+        items = activity.get("activity", [])
+        newItems = []
+        for item in items:
+            id = self._getItemId(item)
+            if id in self._seen:
+                continue
+            self._seen[id] = True
+            newItems.append(item)
+        while len(self._seen) > self._maxSeenItems:
+            self._seen.popitem(last = False)
+        self._updateInterval(len(newItems), len(items) >= self._maxItemCount)
+        return newItems
+
+    # store the lastActivityId and the ids of the returned items to the checkpoint file
+    def saveCheckpoint(self):
+        if self._checkpointFile == None:
+            return
+        _writeJsonFile(self._checkpointFile, { "lastActivityId": self._lastActivityId, "seen": self._seen.keys() })
+
+    # yield the new items as they arrive until stop() is called or maxItems items were returned. the checkpoint is saved
+    # after all the items of a call were consumed, so after a restart no item is lost (but the last batch can be repeated).
+    # items of a call that were not consumed yet are returned first by the next iterItems
+    def iterItems(self, maxItems = None):
+        itemCount = 0
+        while not self._stopEvent.is_set():
+            polled = not self._pending
+            if polled:
+                try:
+                    self._pending.extend(self.poll())
+                    self._lastException = None
+                except Exception as ex:
+                    self._lastException = ex
+                    self._interval = self._maxInterval
+            hasItems = len(self._pending) > 0
+            while self._pending:
+                yield self._pending.popleft()
+                itemCount += 1
+                if maxItems != None and itemCount >= maxItems:
+                    if not self._pending:
+                        self.saveCheckpoint()
+                    return
+            if hasItems:
+                self.saveCheckpoint()
+            if polled:
+                self._stopEvent.wait(self._interval)
+
+    def __iter__(self):
+        return self.iterItems()
+
+    # stop the iterItems loop (can be called from another thread)
+    def stop(self):
+        self._stopEvent.set()
+
+    # return the recent activity part of the response ({ "activity": [...], "lastActivityId": ... })
+    def _getActivity(self):
+        if self._template == None:
+            if self._kind == "articles":
+                res = self._er.getRecentArticles(maxArticleCount = self._maxItemCount, maxMinsBack = self._maxMinsBack, lastActivityId = self._lastActivityId, **self._kwargs)
+            else:
+                res = self._er.getRecentEvents(maxEventCount = self._maxItemCount, maxMinsBack = self._maxMinsBack, lastActivityId = self._lastActivityId, **self._kwargs)
+            if res == None:
+                raise self._er._lastException
+        elif self._kind == "articles":
+            res = self._er._execQuery(self._template.bind(articleRecentActivityLastArticleActivityId = self._lastActivityId))
+        else:
+            res = self._er._execQuery(self._template.bind(eventsRecentActivityLastEventActivityId = self._lastActivityId))
+        if "recentActivity" not in res:
+            raise Exception(res.get("error", "The response doesn't contain the recent activity"))
+        return res["recentActivity"].get(self._kind, {})
+
+    # articles are identified by their uri. an event is returned again each time it is updated, so its id also contains
+    # a hash of its content - an updated event is returned again while the exact same version of it is skipped
+    def _getItemId(self, item):
+        if not isinstance(item, dict):
+            return item
+        id = item.get("uri", item.get("id"))
+        if self._kind == "events":
+            id = "%s:%s" % (id, hashlib.sha1(json.dumps(item, sort_keys = True, default = str)).hexdigest())
+        return id
+
+    # choose the interval so that a call returns about half of maxItemCount items at the observed rate of new items.
+    # if the call returned the max number of items, there are probably more waiting and the next call is made sooner
+    def _updateInterval(self, newItemCount, isFull):
+        now = time.time()
+        if self._lastPollTime != None:
+            rate = newItemCount / max(now - self._lastPollTime, 0.001)
+            self._itemRate = rate if self._itemRate == None else 0.7 * self._itemRate + 0.3 * rate
+        self._lastPollTime = now
+        if isFull:
+            self._interval = self._minInterval
+        elif self._itemRate == None:
+            pass
+        elif self._itemRate > 0:
+            self._interval = 0.5 * self._maxItemCount / self._itemRate
+        else:
+            self._interval = self._interval * 2
+        self._interval = min(max(self._interval, self._minInterval), self._maxInterval)
+
+
+# export of all the articles (QueryArticles) or events (QueryEvents) that match the query into a file with one json item per line,
+# which can be resumed after the process was stopped or an export failed. the date range of the query is split into shards (see
+# EventRegistry.getDateShards) that are downloaded in parallel. after each page is appended to the output file, the progress (the pages
+# done in each shard, the id of the last item of the shard and the size of the output file) is saved to the checkpoint file. when the
+# job is created again with the same query and files, run() continues with the pages that were not completed yet. any data written to
+# the output after the last checkpoint is removed first, so every item is written exactly once
+class ExportJob(object):
+    def __init__(self, eventRegistry, query, outputFile, checkpointFile = None, workers = 4, shardSize = 5000, pageSize = 200, maxShardRetries = 3):
+        if isinstance(query, QueryArticles):
+            self._requestClass, self._resultKey = RequestArticlesInfo, "articles"
+        elif isinstance(query, QueryEvents):
+            self._requestClass, self._resultKey = RequestEventsInfo, "events"
+        else:
+            raise ValueError("Only QueryArticles and QueryEvents can be exported")
+        self._er = eventRegistry
+        self._query = query
+        self._outputFile = outputFile
+        self._checkpointFile = checkpointFile if checkpointFile != None else outputFile + ".checkpoint"
+        self._workers = workers
+        self._shardSize = shardSize
+        self._maxShardRetries = maxShardRetries
+        # the fingerprint of the page query (the query itself might not have any requested results), without the page size,
+        # which is stored in the checkpoint
+        pageTemplate = eventRegistry._getPageTemplate(query, self._requestClass, pageSize).bind(**{ self._resultKey + "Count": None })
+        self._checkpoint = {
+            "fingerprint": pageTemplate._getFingerprint(),
+            "pageSize": pageSize,
+            "shards": None,             # list of [dateStart, dateEnd]
+            "pagesDone": [],            # number of completed pages in each shard
+            "pageCounts": [],           # number of pages in each shard (None if not known yet)
+            "lastIds": [],              # uri or id of the last exported item in each shard
+            "itemCount": 0,
+            "outputSize": 0 }
+        if os.path.exists(self._checkpointFile):
+            with open(self._checkpointFile) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("fingerprint") != self._checkpoint["fingerprint"]:
+                raise ValueError("The checkpoint file %s belongs to a different query" % self._checkpointFile)
+            self._checkpoint = checkpoint
+
+    # return True if all the pages of all the shards were exported
+    def isDone(self):
+        checkpoint = self._checkpoint
+        return checkpoint["shards"] != None and all(count != None and done >= count for done, count in zip(checkpoint["pagesDone"], checkpoint["pageCounts"]))
+
+    # return a dict with the number of shards, completed shards and exported items
+    def getProgress(self):
+        checkpoint = self._checkpoint
+        shardCount = len(checkpoint["shards"] or [])
+        shardsDone = sum(1 for done, count in zip(checkpoint["pagesDone"], checkpoint["pageCounts"]) if count != None and done >= count)
+        return { "shards": shardCount, "shardsDone": shardsDone, "itemCount": checkpoint["itemCount"] }
+
+    # export the remaining pages and return the total number of exported items. if a shard can't be downloaded, the exception
+    # is raised; the completed pages are kept and the job can be run again later
+    def run(self):
+        checkpoint = self._checkpoint
+        if checkpoint["shards"] == None:
+            shards = self._er.getDateShards(self._query, self._shardSize, self._workers)
+            checkpoint["shards"] = [list(shard) for shard in shards]
+            checkpoint["pagesDone"] = [0] * len(shards)
+            checkpoint["pageCounts"] = [None] * len(shards)
+            checkpoint["lastIds"] = [None] * len(shards)
+            self._saveCheckpoint()
+        pending = [i for i in range(len(checkpoint["shards"])) if checkpoint["pageCounts"][i] == None or checkpoint["pagesDone"][i] < checkpoint["pageCounts"][i]]
+        if not pending:
+            return checkpoint["itemCount"]
+        pageSize = checkpoint["pageSize"]
+        with open(self._outputFile, "ab") as output:
+            # drop what was written after the last checkpoint
+            output.truncate(checkpoint["outputSize"])
+            output.seek(0, os.SEEK_END)
+            pages = self._er._iterShardPages(self._query, self._requestClass, self._resultKey, [checkpoint["shards"][i] for i in pending],
+                                             [checkpoint["pagesDone"][i] for i in pending], self._workers, pageSize, self._maxShardRetries)
+            for index, page, pageCount, items in pages:
+                shardIndex = pending[index]
+                for item in items:
+                    output.write(json.dumps(item) + "\n")
+                output.flush()
+                os.fsync(output.fileno())
+                checkpoint["pagesDone"][shardIndex] = page + 1
+                checkpoint["pageCounts"][shardIndex] = pageCount
+                if items:
+                    checkpoint["lastIds"][shardIndex] = items[-1].get("uri", items[-1].get("id"))
+                checkpoint["itemCount"] += len(items)
+                checkpoint["outputSize"] = output.tell()
+                self._saveCheckpoint()
+        return checkpoint["itemCount"]
+
+    def _saveCheckpoint(self):
+        _writeJsonFile(self._checkpointFile, self._checkpoint)
@@ -0,0 +1,245 @@
+"""
+local stand-in for the Event Registry service, for testing and benchmarking the client without network access.
+the server answers the requests with recorded responses (see ResponseRecorder) or with synthetic ones
+"""
+import BaseHTTPServer, SocketServer, socket, sys, threading, urlparse, json, random, time, datetime
+from EventRegistry import getRequestFingerprint
+
+# return the key of the request that is used to find the recorded response. params are the parsed
+# parameters of the request (as returned by urlparse.parse_qs)
+def getFixtureKey(path, params):
+    return getRequestFingerprint(path, params)
+
+# return the path and the parsed parameters of the request with the given url and post data
+def parseRequest(url, data = None):
+    parts = urlparse.urlsplit(url)
+    return parts.path, urlparse.parse_qs(data if data != None else parts.query, keep_blank_values = True)
+
+# load the recorded responses from a file created by ResponseRecorder into a dict { key: response }
+def loadFixtures(fileName):
+    fixtures = {}
+    with open(fileName) as f:
+        for line in f:
+            if line.strip():
+                fixture = json.loads(line)
+                fixtures[fixture["key"]] = fixture["response"].encode("utf8")
+    return fixtures
+
+
+class ResponseRecorder(object):
+    """
+    records the responses that an EventRegistry instance receives from the service into a file (one json object
+    per line), which can then be loaded with loadFixtures and served by MockServer
+    """
+    def __init__(self, eventRegistry, fileName):
+        self._fileName = fileName
+        self._lock = threading.Lock()
+        self.recordedCount = 0
+        getUrlResponse = eventRegistry._getUrlResponse
+        # record the responses returned by _getUrlResponse of this instance. streamed responses are not recorded
+        def recordingGetUrlResponse(url, data = None, stream = False, path = None):
+            respInfo = getUrlResponse(url, data, stream, path)
+            if respInfo != None and not stream:
+                self.record(url, data, respInfo)
+            return respInfo
+        eventRegistry._getUrlResponse = recordingGetUrlResponse
+
+    def record(self, url, data, respInfo):
+        path, params = parseRequest(url, data)
+        line = json.dumps({ "key": getFixtureKey(path, params), "path": path, "response": respInfo.decode("utf8") })
+        with self._lock:
+            with open(self._fileName, "a") as f:
+                f.write(line + "\n")
+            self.recordedCount += 1
+
+
+class _MockRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # keep the connections alive
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, params = parseRequest(self.path)
+        self._reply(path, params)
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path, params = parseRequest(self.path, data if data else None)
+        self._reply(path, params)
+
+    def _reply(self, path, params):
+        body = self.server.mock.getResponse(path, params)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _MockHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, handlerClass):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handlerClass)
+        self._connections = set()
+        self._connectionsLock = threading.Lock()
+
+    def process_request(self, request, clientAddress):
+        with self._connectionsLock:
+            self._connections.add(request)
+        SocketServer.ThreadingMixIn.process_request(self, request, clientAddress)
+
+    def shutdown_request(self, request):
+        with self._connectionsLock:
+            self._connections.discard(request)
+        BaseHTTPServer.HTTPServer.shutdown_request(self, request)
+
+    # close the keep-alive connections and wait (at most timeout seconds) until their threads exit
+    def closeConnections(self, timeout = 1):
+        with self._connectionsLock:
+            connections = list(self._connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+        endTime = time.time() + timeout
+        while self._connections and time.time() < endTime:
+            time.sleep(0.01)
+
+    # the clients closing their connections are not errors
+    def handle_error(self, request, clientAddress):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, clientAddress)
+
+
+class MockServer(object):
+    """
+    local http server that imitates the Event Registry api. the requests to /json/event, /json/article, /json/suggest* and
+    /json/overview are answered with the recorded response for the same request (fixtures, see loadFixtures) if there is one,
+    and otherwise with a synthetic response of the requested result types. latency is the number of seconds that every
+    response is delayed, resultCount the number of articles and events that match every query and bodyLen the length of the
+    article bodies. use it with EventRegistry(host = server.getUrl())
+    """
+    def __init__(self, port = 0, latency = 0, fixtures = None, resultCount = 10000, bodyLen = 1000, seed = 0):
+        self._latency = latency
+        self._fixtures = fixtures if fixtures != None else {}
+        self._resultCount = resultCount
+        self._lock = threading.Lock()
+        self.requestCount = 0
+        rnd = random.Random(seed)
+        # the items are serialized in advance, so that the server itself is not the bottleneck of the benchmarks
+        self._articles = [json.dumps(self._createArticle(rnd, i, bodyLen)) for i in range(min(resultCount, 1000))]
+        self._events = [json.dumps(self._createEvent(rnd, i)) for i in range(min(resultCount, 1000))]
+        self._server = _MockHttpServer(("127.0.0.1", port), _MockRequestHandler)
+        self._server.mock = self
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target = self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.closeConnections()
+        self._server.server_close()
+
+    def getUrl(self):
+        return "http://127.0.0.1:%d" % self._server.server_address[1]
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.stop()
+
+    def getResponse(self, path, params):
+        with self._lock:
+            self.requestCount += 1
+        if self._latency > 0:
+            time.sleep(self._latency)
+        key = getFixtureKey(path, params)
+        if key in self._fixtures:
+            return self._fixtures[key]
+        action = params.get("action", [""])[0]
+        if path == "/login":
+            return "{}"
+        if path.startswith("/json/suggest"):
+            return self._getSuggestions(params)
+        if path == "/json/overview":
+            return self._getOverview(action, params)
+        if path == "/json/article":
+            return self._getItemsResponse(action == "getArticles", "article", params, self._articles, params.get("articleUri", []) + params.get("articleId", []) + params.get("articleUrl", []))
+        if path == "/json/event":
+            return self._getItemsResponse(action == "getEvents", "event", params, self._events, params.get("eventUri", []))
+        return json.dumps({ "error": "Unknown method %s" % path })
+
+    # response of QueryArticles/QueryEvents (isList = True) or QueryArticle/QueryEvent
+    def _getItemsResponse(self, isList, name, params, items, uris):
+        if not isList:
+            return "{" + ",".join(['%s:{"info":%s}' % (json.dumps(uri), items[i % len(items)]) for i, uri in enumerate(uris)]) + "}"
+        parts = []
+        for resultType in params.get("resultType", []):
+            if resultType in ("articles", "events"):
+                page = int(params.get(resultType + "Page", ["0"])[0])
+                count = int(params.get(resultType + "Count", ["20"])[0])
+                start = min(page * count, self._resultCount)
+                end = min(start + count, self._resultCount)
+                results = ",".join([items[i % len(items)] for i in range(start, end)])
+                parts.append('"%s":{"resultCount":%d,"page":%d,"results":[%s]}' % (resultType, self._resultCount, page, results))
+            elif resultType == "uriList":
+                parts.append('"uriList":%s' % json.dumps([str(i) for i in range(min(self._resultCount, 1000))]))
+            elif resultType == "timeAggr":
+                dates = [(datetime.date(2014, 1, 1) + datetime.timedelta(days = i)).isoformat() for i in range(30)]
+                parts.append('"timeAggr":{"results":%s}' % json.dumps([{ "date": date, "count": self._resultCount / 30 } for date in dates]))
+            else:
+                parts.append('%s:{}' % json.dumps(resultType))
+        return "{" + ",".join(parts) + "}"
+
+    def _getSuggestions(self, params):
+        prefix = params.get("prefix", [""])[0]
+        count = int(params.get("count", ["20"])[0])
+        return json.dumps([{ "uri": "http://en.wikipedia.org/wiki/%s_%d" % (prefix, i), "label": { "eng": "%s %d" % (prefix, i) }, "type": "wiki" } for i in range(count)])
+
+    def _getOverview(self, action, params):
+        if action == "getRecentStats":
+            return json.dumps({ "totalArticleCount": self._resultCount, "totalEventCount": self._resultCount })
+        parts = []
+        if params.get("addArticles", ["False"])[0] == "True":
+            count = int(params.get("recentActivityArticlesMaxArticleCount", ["60"])[0])
+            parts.append('"articles":{"activity":[%s],"lastActivityId":%d}' % (",".join(self._articles[:count]), count))
+        if params.get("addEvents", ["False"])[0] == "True":
+            count = int(params.get("recentActivityEventsMaxEventCount", ["60"])[0])
+            parts.append('"events":{"activity":[%s],"lastActivityId":%d}' % (",".join(self._events[:count]), count))
+        return '{"recentActivity":{' + ",".join(parts) + "}}"
+
+    def _createArticle(self, rnd, i, bodyLen):
+        return {
+            "uri": str(200000000 + i),
+            "lang": rnd.choice(["eng", "deu", "spa"]),
+            "date": "2014-04-%02d" % rnd.randint(1, 28),
+            "time": "%02d:%02d:%02d" % (rnd.randint(0, 23), rnd.randint(0, 59), rnd.randint(0, 59)),
+            "url": "http://www.example.com/news/%d" % i,
+            "title": "Title of the article %d" % i,
+            "body": "x" * bodyLen,
+            "source": { "uri": "source%d.com" % rnd.randint(0, 200), "title": "Source" },
+            "eventUri": str(rnd.randint(1000000, 1001000)),
+            "sim": rnd.random(),
+            "concepts": [{ "uri": "http://en.wikipedia.org/wiki/Concept_%d" % rnd.randint(0, 2000), "type": "wiki", "score": rnd.randint(1, 5) } for j in range(10)]
+            }
+
+    def _createEvent(self, rnd, i):
+        return {
+            "uri": str(1000000 + i),
+            "eventDate": "2014-04-%02d" % rnd.randint(1, 28),
+            "articleCounts": { "total": rnd.randint(1, 500) },
+            "wgt": rnd.randint(1, 100),
+            "multiLingInfo": { "eng": { "title": "Event %d" % i, "summary": "y" * 300 } },
+            "concepts": [{ "uri": "http://en.wikipedia.org/wiki/Concept_%d" % rnd.randint(0, 2000), "type": "wiki", "score": rnd.randint(1, 100) } for j in range(20)]
+            }